@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Compares the model inference of the separate scaler/quantile model calls with the FusedPredictor.
+
+Run with python benchmarks/bench_inference.py [--sizes 1 100 10000] [--repeats 5]
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from mofcolorizer.models import QUANTILE_MODELS, load_fused_predictor, load_models
+from mofcolorizer.schema import CHEMICAL_FEATURES
+
+
+def separate_models(features):
+    """Scaling on a DataFrame and one predict call per quantile model, shape (n, 3, 3)"""
+    models = load_models()
+    scaled = models['SCALER'].transform(pd.DataFrame(features, columns=CHEMICAL_FEATURES))
+    return np.stack([models[name].predict(scaled) for name in QUANTILE_MODELS], axis=1)
+
+
+def fused_model(features):
+    return load_fused_predictor()(features)
+
+
+def best_time(func, features, repeats):
+    """Best wall time of repeats calls, in seconds"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(features)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def random_features(size, seed=0):
+    """Features that look like the training set after scaling, i.e. normal with the mean and scale of the scaler"""
+    rng = np.random.default_rng(seed)
+    scaler = load_models()['SCALER']
+    features = rng.normal(size=(size, len(CHEMICAL_FEATURES)))
+    return features * getattr(scaler, 'scale_', 1) + getattr(scaler, 'mean_', 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1, 10, 100, 1000, 10000, 100000])
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    # warm up, e.g. loading the models
+    separate_models(random_features(1))
+    fused_model(random_features(1))
+
+    print('{:>8} {:>14} {:>14} {:>8} {:>10}'.format('n', 'separate / s', 'fused / s', 'speedup', 'identical'))
+    for size in args.sizes:
+        features = random_features(size)
+        identical = np.array_equal(separate_models(features), fused_model(features))
+        separate = best_time(separate_models, features, args.repeats)
+        fused = best_time(fused_model, features, args.repeats)
+        print('{:>8} {:>14.6f} {:>14.6f} {:>8.2f} {:>10}'.format(size, separate, fused, separate / fused,
+                                                                 str(identical)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the featurization, the model inference and closest_name, the results are appended to a history file.
+
+Run with python benchmarks/bench_suite.py [--structures benchmarks/structures] [--repeats 3]
+[--history benchmarks/history.json] [--skip-featurization]
+
+Every benchmark runs in a fresh process, such that the peak RSS of each can be reported (for the featurization
+also the one of the external programs, e.g. the JVM of MOFid). The caches are written to a temporary directory and
+cleared between repeats, i.e., every featurization really runs MOFid and molSimplify.
+The table compares the results with the last run in the history, e.g. the one of the previous commit.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def peak_rss():
+    """Peak RSS of this process and of its (terminated) child processes, in MB"""
+    return {
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def bench_featurization(cif, repeats):
+    """End-to-end latency of get_color_descriptors and the mean time per stage"""
+    from mofcolorizer import featurize, metrics  # pylint:disable=import-outside-toplevel
+    metrics.start_child()  # keep the timings in memory, i.e., do not write them to the metrics directory
+
+    timings = []
+    try:
+        for _ in range(repeats):
+            featurize.LINKER_CACHE.clear()
+            start = time.perf_counter()
+            featurize.get_color_descriptors(cif)
+            timings.append(time.perf_counter() - start)
+    except Exception as e:  # pylint:disable=broad-except,invalid-name
+        return dict(peak_rss(), error='{}: {}'.format(type(e).__name__, e))
+
+    histograms = metrics.snapshot()['histograms']
+    stages = {stage: histogram['sum'] / histogram['count'] for stage, histogram in histograms.items()}
+    return dict(peak_rss(), latency_s=min(timings), mean_latency_s=float(np.mean(timings)), stages_s=stages)
+
+
+def bench_inference(sizes, repeats):
+    """Rows per second of the fused scaler and quantile models for batches of different sizes"""
+    from bench_inference import best_time, fused_model, random_features  # pylint:disable=import-outside-toplevel
+    fused_model(random_features(1))  # load the models
+    throughput = {}
+    for size in sizes:
+        throughput[str(size)] = size / best_time(fused_model, random_features(size), repeats)
+    return dict(peak_rss(), rows_per_s=throughput)
+
+
+def bench_closest_name(size, repeats):
+    """Colors per second of closest_names (batched), closest_name (one call per color) and lookup_names (from the
+    lookup table, if it was built)"""
+    from mofcolorizer.utils import closest_name, closest_names  # pylint:disable=import-outside-toplevel
+    from mofcolorizer.xkcd_lut import lookup_names  # pylint:disable=import-outside-toplevel
+    colors = np.random.default_rng(0).integers(0, 256, size=(size, 3))
+    closest_names(colors[:1])  # build the palette
+    lookup_names(colors[:1])  # map the table
+
+    batched, single, lookup = [], [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        lookup_names(colors)
+        lookup.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        closest_names(colors)
+        batched.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for color in colors[:1000]:
+            closest_name(color)
+        single.append(time.perf_counter() - start)
+
+    return dict(peak_rss(),
+                batched_colors_per_s=size / min(batched),
+                lookup_colors_per_s=size / min(lookup),
+                single_colors_per_s=min(len(colors), 1000) / min(single))
+
+
+def _send_result(connection, func, args):
+    try:
+        connection.send((True, func(*args)))
+    except Exception as e:  # pylint:disable=broad-except,invalid-name
+        connection.send((False, '{}: {}'.format(type(e).__name__, e)))
+    finally:
+        connection.close()
+
+
+def run_isolated(func, *args):
+    """Run func(*args) in a new process and return its result. Not in a Pool: its processes are daemonic and
+    cannot start the processes of the featurization stages"""
+    context = multiprocessing.get_context('spawn')
+    parent_connection, child_connection = context.Pipe(duplex=False)
+    process = context.Process(target=_send_result, args=(child_connection, func, args))
+    process.start()
+    child_connection.close()
+    try:
+        success, payload = parent_connection.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError('{} exited with code {}'.format(func.__name__, process.exitcode))
+    process.join()
+    if not success:
+        raise RuntimeError('{} failed: {}'.format(func.__name__, payload))
+    return payload
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=THIS_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    """All numbers of the nested results as {'featurization.cu_hkust1.latency_s': ...}"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def print_comparison(current, previous):
+    current, previous = flatten(current), flatten(previous or {})
+    print('{:<60} {:>14} {:>14} {:>8}'.format('', 'this run', 'last run', 'ratio'))
+    for key, value in sorted(current.items()):
+        before = previous.get(key)
+        ratio = '{:.2f}'.format(value / before) if before else ''
+        print('{:<60} {:>14.4g} {:>14} {:>8}'.format(key, value, '' if before is None else '{:.4g}'.format(before),
+                                                     ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--structures', default=os.path.join(THIS_DIR, 'structures'), help='directory with cifs')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1, 100, 10000], help='batch sizes for the models')
+    parser.add_argument('--colors', type=int, default=100000, help='number of colors for closest_names')
+    parser.add_argument('--history', default=os.path.join(THIS_DIR, 'history.json'))
+    parser.add_argument('--skip-featurization', action='store_true', help='e.g. if MOFid is not installed')
+    args = parser.parse_args()
+
+    # the benchmark processes inherit the environment, they must not use (or fill) the caches of the app
+    scratch = tempfile.mkdtemp(prefix='mofcolorizer-bench-')
+    os.environ['MOFCOLORIZER_CACHE_DIR'] = scratch
+    os.environ['MOFCOLORIZER_METRICS_DIR'] = os.path.join(scratch, 'metrics')
+
+    cifs = sorted(glob.glob(os.path.join(args.structures, '*.cif')))
+    results = {'featurization': {}}
+    if not args.skip_featurization:
+        for cif in cifs:
+            name = os.path.splitext(os.path.basename(cif))[0]
+            print('featurizing', name)
+            results['featurization'][name] = run_isolated(bench_featurization, cif, args.repeats)
+    print('model inference')
+    results['inference'] = run_isolated(bench_inference, args.sizes, args.repeats)
+    print('closest_name')
+    results['closest_name'] = run_isolated(bench_closest_name, args.colors, args.repeats)
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as handle:
+            history = json.load(handle)
+
+    print_comparison(results, history[-1]['results'] if history else None)
+    for name, result in results['featurization'].items():
+        if 'error' in result:
+            print('{} failed: {}'.format(name, result['error']))
+
+    history.append({
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'repeats': args.repeats,
+        'results': results,
+    })
+    with open(args.history, 'w') as handle:
+        json.dump(history, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
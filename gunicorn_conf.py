@@ -1,9 +1,29 @@
 # -*- coding: utf-8 -*-
 # pylint:disable=invalid-name
 """Settings for gunicorn"""
+import gc
 
 #https://pythonspeed.com/articles/gunicorn-in-docker/
 worker_tmp_dir = '/dev/shm'
 workers = 2
 threads = 2
 worker_class = 'gthread'
+
+# Import the app (and load the models) in the master, the workers then share the memory copy-on-write
+preload_app = True
+
+
+def when_ready(server):  # pylint:disable=unused-argument
+    """Runs in the master before the workers are forked"""
+    from mofcolorizer.featurize import load_rac_schema  # pylint:disable=import-outside-toplevel
+    from mofcolorizer.metrics import enable_persistence  # pylint:disable=import-outside-toplevel
+    from mofcolorizer.models import load_models  # pylint:disable=import-outside-toplevel
+
+    # the workers share their metrics via files, the ones of processes of earlier runs are removed
+    enable_persistence()
+    load_models()
+    # fails the start if the installed molSimplify does not compute the RACs of the models. Runs molSimplify only on
+    # the first start with a molSimplify version
+    load_rac_schema()
+    # keep the garbage collector from touching (and thereby copying) the objects that exist at this point
+    gc.freeze()
@@ -12,12 +12,16 @@ import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
-from flask import session
+from flask import Response, jsonify, request, session, stream_with_context
 from flask_session import Session
 from pymatgen import Lattice, Structure
 
 from . import dash_reusable_components as drc
-from .core import MODEL_MEDIAN, predict
+from .api import TAR_MIMETYPES, reserve, stream_predictions, uploads
+from .core import MODEL_VERSION, predict_many, render_prediction
+from .jobs import DONE, FAILED, JOB_QUEUE, JOB_TIMEOUT, QueueFullError
+from .metrics import render_prometheus
+from .structure_store import STRUCTURE_STORE
 
 __version__ = 'v0.1-alpha (20/07/2020)'
 
@@ -49,6 +53,31 @@ app = dash.Dash(  # pylint:disable=invalid-name
 server = app.server  # pylint:disable=invalid-name
 app.title = 'mofcolorizer'
 
+
+@server.route('/metrics')
+def prometheus_metrics():
+    """Timings of the featurization and prediction stages for Prometheus"""
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@server.route('/api/predict', methods=['POST'])
+def api_predict():
+    """Predictions for cifs (or tar archives of cifs) uploaded as multipart form or for a tar archive as body,
+    streamed as one JSON line per structure"""
+    if request.mimetype not in TAR_MIMETYPES and not request.files:
+        return jsonify({'error': 'Upload cif files or a tar archive of cif files'}), 400
+    try:
+        release = reserve()
+    except QueueFullError:
+        return jsonify({'error': 'The server is busy at the moment, try again in a few minutes'}), 503, {
+            'Retry-After': '60'
+        }
+    response = Response(stream_with_context(stream_predictions(uploads(request))), mimetype='application/x-ndjson')
+    # also when the client disconnects in the middle of the stream
+    response.call_on_close(release)
+    return response
+
+
 STRUCTURE = Structure(Lattice.cubic(4.2), ['Na', 'K'], [[0, 0, 0], [0.5, 0.5, 0.5]])
 
 structure_component = ctc.StructureMoleculeComponent(  # pylint:disable=invalid-name
@@ -61,6 +90,8 @@ structure_component = ctc.StructureMoleculeComponent(  # pylint:disable=invalid-
 layout = html.Div(  # pylint:disable=invalid-name
     [
         dcc.Store(id='memorystore'),
+        dcc.Store(id='jobstore'),
+        dcc.Interval(id='job_interval', interval=2000, disabled=True),
         html.Div(
             [
                 html.Div(
@@ -155,7 +186,7 @@ layout = html.Div(  # pylint:disable=invalid-name
                 html.Hr(),
                 html.Footer(
                     '© Laboratory of Molecular Simulation (LSMO), École polytechnique fédérale de Lausanne (EPFL). Web app version {}, model {}.'
-                    .format(__version__, MODEL_MEDIAN)),
+                    .format(__version__, MODEL_VERSION)),
             ],
             className='container',
         ),
@@ -167,23 +198,58 @@ layout = html.Div(  # pylint:disable=invalid-name
 ctc.register_crystal_toolkit(app, layout=layout)
 
 
+def _predict_structure(token):
+    """Runs in the job queue, returns the prediction record of predict_many"""
+    structure = STRUCTURE_STORE.get(token)
+    if structure is None:
+        raise KeyError('The structure {} is no longer in the structure store'.format(token))
+    return predict_many([structure], timeout=JOB_TIMEOUT)[0]
+
+
+def _job_failed_alert():
+    return dbc.Alert(
+        'The prediction failed. Please try again later.',
+        dismissable=True,
+        color='warning',
+    )
+
+
 @app.callback(
-    Output('resultdiv', 'children'),
-    [Input('memorystore', 'modified_timestamp')],
-    [State('memorystore', 'data')],
+    [Output('resultdiv', 'children'),
+     Output('jobstore', 'data'),
+     Output('job_interval', 'disabled')],
+    [Input('memorystore', 'modified_timestamp'),
+     Input('job_interval', 'n_intervals')],
+    [State('memorystore', 'data'), State('jobstore', 'data')],
 )
-def run_prediction(_, store):
-    """Returns the prediction table"""
+def run_prediction(_, __, store, job):
+    """Submits the prediction job for a new structure and returns the prediction table once the job is done"""
+    triggered = [trigger['prop_id'] for trigger in dash.callback_context.triggered]
+
+    if 'job_interval.n_intervals' in triggered:
+        if not job or not job.get('job_id'):
+            return dash.no_update, None, True
+        status = JOB_QUEUE.status(job['job_id'])
+        if status is None or status['status'] == FAILED:
+            app.logger.error('prediction job failed: %s', status)
+            return _job_failed_alert(), None, True
+        if status['status'] == DONE:
+            return render_prediction(status['result']), None, True
+        raise PreventUpdate
+
     app.logger.info('triggering prediction update')
     try:
-        if store['structure'] is not None:
-            with drc.temp() as tempfilehandle:
-                s = Structure.from_dict(store['structure'])  # pylint: disable=invalid-name
-                s.to(filename=tempfilehandle.name, fmt='cif')
-                prediction = predict(tempfilehandle.name)
-            return prediction
+        if store['token'] is not None:
+            job_id = JOB_QUEUE.submit(_predict_structure, store['token'])
+            return html.P('Running the prediction, this can take a minute.'), {'job_id': job_id}, False
 
         raise PreventUpdate
+    except QueueFullError:
+        return dbc.Alert(
+            'The server is busy at the moment. Please try again in a few minutes.',
+            dismissable=True,
+            color='warning',
+        ), None, True
     except Exception as e:  # pylint:disable=broad-except,invalid-name
         print(e)
         raise PreventUpdate
@@ -207,18 +273,16 @@ def update_structure(content, new_filename, store):
             # print(structure_str)
             try:
                 structure_object = Structure.from_str(structure_str, fmt='cif')
-                str_dict = structure_object.as_dict()
                 store['filename'] = new_filename
-                # session["structure"] = str_dict
-                # session["filename"] = new_filename
                 # We need to give the user somehow feedback ...git
-                store['structure'] = str_dict
+                # The structure stays on the server, the browser only gets the token
+                store['token'] = STRUCTURE_STORE.put(structure_object)
                 return store, ''
             except Exception:  # pylint:disable=broad-except
                 return store, 'There has been a problem with loading the structure.'
 
     except Exception:  # pylint:disable=broad-except
-        store = {'filename': None, 'structure': None}
+        store = {'filename': None, 'token': None}
 
     return store, ''
 
@@ -232,8 +296,10 @@ def update_structure_viz(_, store):
     """Updates the crystaltoolkit visualizer"""
     app.logger.info('triggering structure viz update')
     try:
-        if store['structure'] is not None:
-            return Structure.from_dict(store['structure'])
+        if store['token'] is not None:
+            structure = STRUCTURE_STORE.get(store['token'])
+            if structure is not None:
+                return structure
         raise PreventUpdate
     except Exception:  # pylint:disable=broad-except
         raise PreventUpdate
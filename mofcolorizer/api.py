@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""HTTP API for pipelines: predictions for many structures, streamed back as newline-delimited JSON.
+
+curl -F files=@a.cif -F files=@b.cif <host>/api/predict
+curl -F files=@structures.tar.gz <host>/api/predict
+curl -H 'Content-Type: application/x-tar' --data-binary @structures.tar <host>/api/predict
+
+Every line is the result of one structure (see core.predict_featurized) with its name, in the order in which the
+structures are done. The structures are read from the upload while the first ones are already featurized.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tarfile
+import threading
+
+from .core import featurize_stream, predict_featurized
+from .jobs import JOB_QUEUE, JOB_TIMEOUT, QueueFullError
+from .utils import make_temp_directory
+
+API_WORKERS = int(os.environ.get('MOFCOLORIZER_API_WORKERS', 1))
+API_MAX_STRUCTURES = int(os.environ.get('MOFCOLORIZER_API_MAX_STRUCTURES', 100))
+# requests that are streamed at the same time per process, the others get 503. Every one of them occupies a request
+# thread for as long as the featurizations take, the web app needs the remaining ones
+API_CONCURRENCY = int(os.environ.get('MOFCOLORIZER_API_CONCURRENCY', 1))
+
+TAR_MIMETYPES = ('application/x-tar', 'application/x-gtar', 'application/gzip', 'application/x-gzip')
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+_STREAMS = threading.BoundedSemaphore(API_CONCURRENCY)
+
+
+def reserve():
+    """Takes one of the API_CONCURRENCY streams and a slot of the job queue, i.e., the featurizations of a request
+    count towards the ones the process accepts. Raises QueueFullError if one of them is not free, returns the function
+    that releases both"""
+    if not _STREAMS.acquire(blocking=False):  # pylint:disable=consider-using-with
+        raise QueueFullError('There are already too many API requests running')
+    try:
+        release_job_slot = JOB_QUEUE.reserve()
+    except QueueFullError:
+        _STREAMS.release()
+        raise
+
+    def release():
+        release_job_slot()
+        _STREAMS.release()
+
+    return release
+
+
+def _tar_members(fileobj):
+    """Yields (name, file object) for the cifs in a (compressed) tar archive, which is read as a stream"""
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile() and member.name.endswith('.cif'):
+                yield member.name, archive.extractfile(member)
+
+
+def uploads(request):
+    """Yields (name, file object) for the cifs of a multipart upload (which can contain tar archives) or of a tar
+    archive in the body of the request"""
+    if request.mimetype in TAR_MIMETYPES:
+        yield from _tar_members(request.stream)
+        return
+    for _, upload in request.files.items(multi=True):
+        if upload.filename.endswith(TAR_SUFFIXES):
+            yield from _tar_members(upload.stream)
+        else:
+            yield upload.filename, upload.stream
+
+
+def stream_predictions(structures, n_workers=API_WORKERS, timeout=JOB_TIMEOUT, max_structures=API_MAX_STRUCTURES):
+    """Yields one JSON line per structure for an iterable of (name, file object) of cifs. At most max_structures are
+    predicted, if there are more, the last line only has an error. So does it if a tar archive in the upload is
+    broken, the structures before the broken part are predicted."""
+    names = []
+    truncated = False
+    broken_archive = None
+
+    with make_temp_directory() as temp_dir:
+
+        def cifs():
+            nonlocal truncated, broken_archive
+            try:
+                for name, fileobj in structures:
+                    if len(names) >= max_structures:
+                        truncated = True
+                        return
+                    path = os.path.join(temp_dir, '{}.cif'.format(len(names)))
+                    with open(path, 'wb') as handle:
+                        shutil.copyfileobj(fileobj, handle)
+                    names.append(name)
+                    yield path
+            except tarfile.TarError as e:  # pylint:disable=invalid-name
+                # e.g. a truncated upload. The response is already being streamed, the error goes into the last line
+                broken_archive = str(e)
+
+        for index, features, error, invalid in featurize_stream(cifs(), n_workers, timeout):
+            os.remove(os.path.join(temp_dir, '{}.cif'.format(index)))
+            result = predict_featurized([(features, error, invalid)])[0]
+            yield json.dumps(dict(result, name=names[index])) + '\n'
+
+    if truncated:
+        yield json.dumps({'name': None, 'error': 'Only the first {} structures are predicted'.format(max_structures)
+                         }) + '\n'
+    if broken_archive is not None:
+        yield json.dumps({'name': None, 'error': 'Could not read the tar archive: {}'.format(broken_archive)}) + '\n'
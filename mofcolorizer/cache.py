@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Persistent caches that are shared between all processes (e.g. gunicorn workers) on one host"""
+from __future__ import absolute_import
+
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+CACHE_DIR = os.environ.get('MOFCOLORIZER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'mofcolorizer'))
+
+
+def _quantize(values, decimals):
+    """Rounded values. The offset keeps values with one decimal more (as in many cif files) off the rounding boundary,
+    where floating point noise would decide. Adding 0 gets rid of -0.0"""
+    return np.round(np.asarray(values) + 1e-9, decimals) + 0.0
+
+
+def structure_hash(structure, decimals=4, canonical=True):
+    """Hash of a pymatgen Structure that does not depend on the order of the sites or on
+    floating point noise below the given number of decimals.
+    With canonical, it also does not depend on the orientation and setting of the cell (the lattice is Niggli-reduced
+    and enters with its parameters) or on the origin (which is put on each site of the rarest species in turn, the
+    smallest fingerprint is used). Cells that differ by a symmetry operation of the reduced lattice (e.g. the
+    permutation of axes of equal length) can still hash differently, this only costs a cache miss"""
+    if canonical:
+        structure = structure.get_reduced_structure('niggli')
+        lattice = _quantize(structure.lattice.parameters, decimals)
+    else:
+        lattice = _quantize(structure.lattice.matrix, decimals)
+    species = [site.species_string for site in structure]
+    frac_coords = structure.frac_coords
+    if canonical and len(structure):
+        rarest = min(set(species), key=lambda specie: (species.count(specie), specie))
+        origins = frac_coords[[i for i, specie in enumerate(species) if specie == rarest]]
+    else:
+        origins = np.zeros((1, 3))
+
+    fingerprints = []
+    for origin in origins:
+        sites = sorted(zip(species, np.mod(_quantize(np.mod(frac_coords - origin, 1), decimals), 1).tolist()))
+        fingerprints.append(json.dumps([lattice.tolist(), sites]))
+    return hashlib.sha256(min(fingerprints).encode('utf-8')).hexdigest()
+
+
+class SQLiteLRUCache:
+    """Size-bounded key-value store in a SQLite file. Values need to be JSON serializable.
+    The least recently used entries are evicted once there are more than max_entries."""
+
+    def __init__(self, path, table='cache', max_entries=10000, namespace=''):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        # is prepended to all keys, e.g. to invalidate the entries of old model versions
+        self.namespace = namespace
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT, accessed REAL)'.format(
+                self.table))
+            connection.execute('CREATE INDEX IF NOT EXISTS {0}_accessed ON {0} (accessed)'.format(self.table))
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Short-lived connection, this keeps the cache safe to use from threads and forked processes"""
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _key(self, key):
+        return '{}:{}'.format(self.namespace, key)
+
+    def get(self, key, default=None):
+        """Return the value stored for key and mark it as recently used"""
+        key = self._key(key)
+        with self._connect() as connection:
+            row = connection.execute('SELECT value FROM {} WHERE key = ?'.format(self.table), (key,)).fetchone()
+            if row is None:
+                return default
+            connection.execute('UPDATE {} SET accessed = ? WHERE key = ?'.format(self.table), (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """Store value under key and evict the least recently used entries if the cache is full"""
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO {} (key, value, accessed) VALUES (?, ?, ?)'.format(self.table),
+                (self._key(key), json.dumps(value), time.time()),
+            )
+            connection.execute(
+                'DELETE FROM {0} WHERE key IN (SELECT key FROM {0} ORDER BY accessed DESC LIMIT -1 OFFSET ?)'.format(
+                    self.table),
+                (self.max_entries,),
+            )
+
+    def __contains__(self, key):
+        with self._connect() as connection:
+            row = connection.execute('SELECT 1 FROM {} WHERE key = ?'.format(self.table), (self._key(key),)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute('SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+
+    def clear(self):
+        """Remove all entries"""
+        with self._connect() as connection:
+            connection.execute('DELETE FROM {}'.format(self.table))
+
+
+class LRUCache:
+    """Size-bounded in-memory cache (per process) that evicts the least recently used entries, thread-safe"""
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""Command line interface to predict the colors of many structures, e.g. for screening studies.
+
+mofcolorizer structures/ -o colors.csv --workers 8
+
+The output is written in chunks while the structures are featurized. If the output already exists, structures
+that are in it are skipped, i.e., an interrupted run can be continued with the same command.
+
+With --save-features, the features are also kept in a feature store, which can be re-scored later (e.g. after a
+model update) with --from-features and without running the featurization again.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import csv
+import glob
+import os
+import sys
+
+import numpy as np
+
+from .core import QUANTILES, featurize_stream, predict_featurized, predict_features
+from .feature_store import FeatureStore
+from .featurize import load_rac_schema
+from .parallel import DEFAULT_WORKERS
+from .schema import CHEMICAL_FEATURES
+
+COLUMNS = ['name'] + [
+    '{}_{}'.format(field, quantile) for quantile in QUANTILES for field in ('r', 'g', 'b', 'hex', 'xkcd_name')
+] + ['error']
+
+
+def find_cifs(inputs):
+    """Expand directories (recursively) and glob patterns into a sorted list of cif paths"""
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*.cif')
+        paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+
+def to_row(name, result):
+    """Flatten a result of predict_featurized into a row with COLUMNS"""
+    row = {'name': name, 'error': result['error']}
+    for quantile in QUANTILES:
+        rgb = result['rgb_' + quantile] or [None, None, None]
+        row['r_' + quantile], row['g_' + quantile], row['b_' + quantile] = rgb
+        row['hex_' + quantile] = result['hex_' + quantile]
+        row['xkcd_name_' + quantile] = result['name_' + quantile]
+    return row
+
+
+class CSVWriter:
+    """Appends rows to a csv file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def done(self):
+        """Names of the structures that are already in the output"""
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, newline='') as handle:
+            return {row['name'] for row in csv.DictReader(handle)}
+
+    def write(self, rows):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as handle:
+            writer = csv.DictWriter(handle, fieldnames=COLUMNS)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+
+
+class ParquetWriter:
+    """Writes each chunk as a new part file into a directory, which can be read as one Parquet dataset"""
+
+    def __init__(self, path):
+        try:
+            import pyarrow  # pylint:disable=import-outside-toplevel,unused-import
+        except ImportError:
+            raise SystemExit('Writing Parquet files requires pyarrow (pip install pyarrow)')
+        self.path = path
+
+    def _parts(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(glob.glob(os.path.join(self.path, 'part-*.parquet')))
+
+    def done(self):
+        import pyarrow.parquet as pq  # pylint:disable=import-outside-toplevel
+        names = set()
+        for part in self._parts():
+            names.update(pq.read_table(part, columns=['name']).column('name').to_pylist())
+        return names
+
+    def write(self, rows):
+        import pyarrow as pa  # pylint:disable=import-outside-toplevel
+        import pyarrow.parquet as pq  # pylint:disable=import-outside-toplevel
+        os.makedirs(self.path, exist_ok=True)
+        table = pa.Table.from_pylist(rows, schema=_parquet_schema())
+        part = os.path.join(self.path, 'part-{:06d}.parquet'.format(len(self._parts())))
+        # write to a temporary file first such that a crash never leaves a broken part file
+        pq.write_table(table, part + '.tmp')
+        os.replace(part + '.tmp', part)
+
+
+def _parquet_schema():
+    import pyarrow as pa  # pylint:disable=import-outside-toplevel
+    fields = []
+    for column in COLUMNS:
+        fields.append((column, pa.int64() if column[:2] in ('r_', 'g_', 'b_') else pa.string()))
+    return pa.schema(fields)
+
+
+def colorize(cifs, writer, n_workers=1, timeout=None, chunksize=100, feature_store=None):
+    """Featurizes the cifs and writes the predictions in chunks of chunksize structures, returns the number of
+    structures that could not be featurized. If a FeatureStore is given, the features are also written to it"""
+    failures = 0
+    chunk = []
+
+    def flush():
+        # the features first, structures that are in the feature store but not in the output are predicted from the
+        # store when the run is continued (see main)
+        if feature_store is not None:
+            valid = [(name, features) for name, features, _, _ in chunk if features is not None]
+            if valid:
+                feature_store.append([name for name, _ in valid], np.stack([features for _, features in valid]))
+        results = predict_featurized([(features, error, invalid) for _, features, error, invalid in chunk])
+        writer.write([to_row(name, result) for (name, _, _, _), result in zip(chunk, results)])
+        del chunk[:]
+
+    for index, features, error, invalid in featurize_stream(cifs, n_workers, timeout):
+        if error is not None:
+            failures += 1
+            print('{}: {}'.format(cifs[index], error), file=sys.stderr)
+        chunk.append((cifs[index], features, error, invalid))
+        if len(chunk) >= chunksize:
+            flush()
+    if chunk:
+        flush()
+
+    return failures
+
+
+def colorize_features(feature_store, writer, done=(), chunksize=10000):
+    """Writes the predictions for the structures in a FeatureStore that are not in done, without featurization"""
+    ids = feature_store.ids()
+    for start in range(0, len(ids), chunksize):
+        names = ids[start:start + chunksize]
+        todo = [i for i, name in enumerate(names) if name not in done]
+        if todo:
+            features = feature_store.matrix(CHEMICAL_FEATURES, start, start + chunksize)[todo]
+            writer.write([to_row(names[i], result) for i, result in zip(todo, predict_features(features))])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='mofcolorizer',
+                                     description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='*', help='cif files, directories or glob patterns')
+    parser.add_argument('-o', '--output', required=True, help='csv file or Parquet directory')
+    parser.add_argument('--format', choices=['csv', 'parquet'], help='default: guessed from the output name')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help='number of worker processes')
+    parser.add_argument('-t', '--timeout', type=float, help='timeout for the featurization of one structure, in s')
+    parser.add_argument('--chunksize', type=int, default=100, help='number of structures per prediction and write')
+    parser.add_argument('--save-features', help='also write the features to this feature store directory')
+    parser.add_argument('--from-features',
+                        help='predict for all structures in this feature store directory instead of featurizing')
+    args = parser.parse_args(args)
+
+    if not args.inputs and not args.from_features:
+        parser.error('either inputs or --from-features are required')
+
+    output_format = args.format or ('parquet' if args.output.endswith('.parquet') else 'csv')
+    writer = ParquetWriter(args.output) if output_format == 'parquet' else CSVWriter(args.output)
+    done = writer.done()
+
+    if args.from_features:
+        colorize_features(FeatureStore(args.from_features), writer, done)
+        return
+
+    feature_store = FeatureStore(args.save_features, CHEMICAL_FEATURES) if args.save_features else None
+    if feature_store is not None:
+        # e.g. a run that was interrupted after a chunk was added to the feature store but before it was written
+        colorize_features(feature_store, writer, done)
+        done = done | set(feature_store.ids())
+    cifs = find_cifs(args.inputs)
+    todo = [cif for cif in cifs if cif not in done]
+    print('{} structures found, {} already in {}, {} to go'.format(len(cifs),
+                                                                   len(cifs) - len(todo), args.output, len(todo)),
+          file=sys.stderr)
+
+    if todo:
+        # fail before the first structure if the installed molSimplify does not compute the RACs of the models, the
+        # worker processes use the compiled schema
+        load_rac_schema()
+    failures = colorize(todo,
+                        writer,
+                        n_workers=args.workers,
+                        timeout=args.timeout,
+                        chunksize=args.chunksize,
+                        feature_store=feature_store)
+    print('done, {} structures could not be featurized'.format(failures), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,309 +3,180 @@
 """Calls the featurization function, loads the models and uses them to predict"""
 from __future__ import absolute_import, print_function
 
+import hashlib
 import os
 
 import dash_html_components as html
-import joblib
-import pandas as pd
+import numpy as np
 from webcolors import rgb_to_hex
 
 import dash_bootstrap_components as dbc
 
-from .featurize import FeaturizationException, get_color_descriptors
-from .utils import closest_name
+from .cache import CACHE_DIR, LRUCache, SQLiteLRUCache, structure_hash
+from .featurize import (FEATURIZER_VERSION, FeaturizationException, InvalidStructureException,
+                        featurize_primitive_vector, get_primitive_structure)
+from .metrics import increment, timed
+from .models import MODEL_FILES, MODEL_VERSION, load_fused_predictor, load_models
+from .parallel import imap_unordered
+from .xkcd_lut import lookup_names
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 
-SCALER = joblib.load(os.path.join(THIS_DIR, 'scaler_run_2020_09_10_13_19_1599736778.joblib'))
-MODEL_MEDIAN = joblib.load(os.path.join(THIS_DIR, 'regressor_medianrun_2020_09_10_13_19_1599736778False.joblib'))
-MODEL_01 = joblib.load(os.path.join(THIS_DIR, 'regressor_0_1run_2020_09_10_13_19_1599736778False.joblib'))
-MODEL_09 = joblib.load(os.path.join(THIS_DIR, 'regressor_0_9run_2020_09_10_13_19_1599736778False.joblib'))
-
-CHEMICAL_FEATURES = [
-    'mc_CRY-chi-0-all',
-    'mc_CRY-chi-1-all',
-    'mc_CRY-chi-2-all',
-    'mc_CRY-chi-3-all',
-    'mc_CRY-Z-0-all',
-    'mc_CRY-Z-1-all',
-    'mc_CRY-Z-2-all',
-    'mc_CRY-Z-3-all',
-    'mc_CRY-I-1-all',
-    'mc_CRY-I-2-all',
-    'mc_CRY-I-3-all',
-    'mc_CRY-T-0-all',
-    'mc_CRY-T-1-all',
-    'mc_CRY-T-2-all',
-    'mc_CRY-T-3-all',
-    'mc_CRY-S-0-all',
-    'mc_CRY-S-1-all',
-    'mc_CRY-S-2-all',
-    'mc_CRY-S-3-all',
-    'D_mc_CRY-chi-1-all',
-    'D_mc_CRY-chi-2-all',
-    'D_mc_CRY-chi-3-all',
-    'D_mc_CRY-Z-1-all',
-    'D_mc_CRY-Z-2-all',
-    'D_mc_CRY-Z-3-all',
-    'D_mc_CRY-T-1-all',
-    'D_mc_CRY-T-2-all',
-    'D_mc_CRY-T-3-all',
-    'D_mc_CRY-S-1-all',
-    'D_mc_CRY-S-2-all',
-    'D_mc_CRY-S-3-all',
-    'func-chi-0-all',
-    'func-chi-1-all',
-    'func-chi-2-all',
-    'func-chi-3-all',
-    'func-Z-0-all',
-    'func-Z-1-all',
-    'func-Z-2-all',
-    'func-Z-3-all',
-    'func-I-1-all',
-    'func-I-2-all',
-    'func-I-3-all',
-    'func-T-0-all',
-    'func-T-1-all',
-    'func-T-2-all',
-    'func-T-3-all',
-    'func-S-0-all',
-    'func-S-1-all',
-    'func-S-2-all',
-    'func-S-3-all',
-    'func-alpha-0-all',
-    'func-alpha-1-all',
-    'func-alpha-2-all',
-    'func-alpha-3-all',
-    'D_func-chi-1-all',
-    'D_func-chi-2-all',
-    'D_func-chi-3-all',
-    'D_func-Z-1-all',
-    'D_func-Z-2-all',
-    'D_func-Z-3-all',
-    'D_func-T-1-all',
-    'D_func-T-2-all',
-    'D_func-T-3-all',
-    'D_func-S-2-all',
-    'D_func-S-3-all',
-    'D_func-alpha-1-all',
-    'D_func-alpha-2-all',
-    'D_func-alpha-3-all',
-    'f-lig-chi-0',
-    'f-lig-chi-1',
-    'f-lig-chi-2',
-    'f-lig-chi-3',
-    'f-lig-Z-0',
-    'f-lig-Z-1',
-    'f-lig-Z-2',
-    'f-lig-Z-3',
-    'f-lig-I-0',
-    'f-lig-I-1',
-    'f-lig-I-2',
-    'f-lig-I-3',
-    'f-lig-T-0',
-    'f-lig-T-1',
-    'f-lig-T-2',
-    'f-lig-T-3',
-    'f-lig-S-0',
-    'f-lig-S-1',
-    'f-lig-S-2',
-    'f-lig-S-3',
-    'lc-chi-0-all',
-    'lc-chi-1-all',
-    'lc-chi-2-all',
-    'lc-chi-3-all',
-    'lc-Z-0-all',
-    'lc-Z-1-all',
-    'lc-Z-2-all',
-    'lc-Z-3-all',
-    'lc-I-2-all',
-    'lc-I-3-all',
-    'lc-T-0-all',
-    'lc-T-1-all',
-    'lc-T-2-all',
-    'lc-T-3-all',
-    'lc-S-3-all',
-    'lc-alpha-0-all',
-    'lc-alpha-1-all',
-    'lc-alpha-2-all',
-    'lc-alpha-3-all',
-    'D_lc-chi-2-all',
-    'D_lc-chi-3-all',
-    'D_lc-Z-1-all',
-    'D_lc-Z-2-all',
-    'D_lc-Z-3-all',
-    'D_lc-T-1-all',
-    'D_lc-T-2-all',
-    'D_lc-T-3-all',
-    'D_lc-alpha-1-all',
-    'D_lc-alpha-2-all',
-    'D_lc-alpha-3-all',
-    'tertiary_amide_sum',
-    'ester_sum',
-    'carbonyl_sum',
-    'logP_sum',
-    'MR_sum',
-    'aromatic_rings_sum',
-    'dbonds_sum',
-    'abonds_sum',
-    'tertiary_amide_mean',
-    'ester_mean',
-    'carbonyl_mean',
-    'logP_mean',
-    'MR_mean',
-    'aromatic_rings_mean',
-    'dbonds_mean',
-    'abonds_mean',
-    # "sum-func-chi-0-all",
-    # "sum-func-chi-1-all",
-    # "sum-func-chi-2-all",
-    # "sum-func-chi-3-all",
-    # "sum-func-Z-0-all",
-    # "sum-func-Z-1-all",
-    # "sum-func-Z-2-all",
-    # "sum-func-Z-3-all",
-    # "sum-func-I-0-all",
-    # "sum-func-I-1-all",
-    # "sum-func-I-2-all",
-    # "sum-func-I-3-all",
-    # "sum-func-T-0-all",
-    # "sum-func-T-1-all",
-    # "sum-func-T-2-all",
-    # "sum-func-T-3-all",
-    # "sum-func-S-0-all",
-    # "sum-func-S-1-all",
-    # "sum-func-S-2-all",
-    # "sum-func-S-3-all",
-    # "sum-func-alpha-0-all",
-    # "sum-func-alpha-1-all",
-    # "sum-func-alpha-2-all",
-    # "sum-func-alpha-3-all",
-    # "sum-D_func-chi-1-all",
-    # "sum-D_func-chi-2-all",
-    # "sum-D_func-chi-3-all",
-    # "sum-D_func-Z-1-all",
-    # "sum-D_func-Z-2-all",
-    # "sum-D_func-Z-3-all",
-    # "sum-D_func-T-1-all",
-    # "sum-D_func-T-2-all",
-    # "sum-D_func-T-3-all",
-    # "sum-D_func-S-1-all",
-    # "sum-D_func-S-2-all",
-    # "sum-D_func-S-3-all",
-    # "sum-D_func-alpha-1-all",
-    # "sum-D_func-alpha-2-all",
-    # "sum-D_func-alpha-3-all",
-    # "sum-f-lig-chi-0",
-    # "sum-f-lig-chi-1",
-    # "sum-f-lig-chi-2",
-    # "sum-f-lig-chi-3",
-    # "sum-f-lig-Z-0",
-    # "sum-f-lig-Z-1",
-    # "sum-f-lig-Z-2",
-    # "sum-f-lig-Z-3",
-    # "sum-f-lig-I-0",
-    # "sum-f-lig-I-1",
-    # "sum-f-lig-I-2",
-    # "sum-f-lig-I-3",
-    # "sum-f-lig-T-0",
-    # "sum-f-lig-T-1",
-    # "sum-f-lig-T-2",
-    # "sum-f-lig-T-3",
-    # "sum-f-lig-S-0",
-    # "sum-f-lig-S-1",
-    # "sum-f-lig-S-2",
-    # "sum-f-lig-S-3",
-    # "sum-lc-chi-0-all",
-    # "sum-lc-chi-1-all",
-    # "sum-lc-chi-2-all",
-    # "sum-lc-chi-3-all",
-    # "sum-lc-Z-0-all",
-    # "sum-lc-Z-1-all",
-    # "sum-lc-Z-2-all",
-    # "sum-lc-Z-3-all",
-    # "sum-lc-I-0-all",
-    # "sum-lc-I-1-all",
-    # "sum-lc-I-2-all",
-    # "sum-lc-I-3-all",
-    # "sum-lc-T-0-all",
-    # "sum-lc-T-1-all",
-    # "sum-lc-T-2-all",
-    # "sum-lc-T-3-all",
-    # "sum-lc-S-0-all",
-    # "sum-lc-S-1-all",
-    # "sum-lc-S-2-all",
-    # "sum-lc-S-3-all",
-    # "sum-lc-alpha-0-all",
-    # "sum-lc-alpha-1-all",
-    # "sum-lc-alpha-2-all",
-    # "sum-lc-alpha-3-all",
-    # "sum-D_lc-chi-1-all",
-    # "sum-D_lc-chi-2-all",
-    # "sum-D_lc-chi-3-all",
-    # "sum-D_lc-Z-1-all",
-    # "sum-D_lc-Z-2-all",
-    # "sum-D_lc-Z-3-all",
-    # "sum-D_lc-T-1-all",
-    # "sum-D_lc-T-2-all",
-    # "sum-D_lc-T-3-all",
-    # "sum-D_lc-S-1-all",
-    # "sum-D_lc-S-2-all",
-    # "sum-D_lc-S-3-all",
-    # "sum-D_lc-alpha-1-all",
-    # "sum-D_lc-alpha-2-all",
-    # "sum-D_lc-alpha-3-all",
-    # "sum-mc_CRY-chi-0-all",
-    # "sum-mc_CRY-chi-1-all",
-    # "sum-mc_CRY-chi-2-all",
-    # "sum-mc_CRY-chi-3-all",
-    # "sum-mc_CRY-Z-0-all",
-    # "sum-mc_CRY-Z-1-all",
-    # "sum-mc_CRY-Z-2-all",
-    # "sum-mc_CRY-Z-3-all",
-    # "sum-mc_CRY-I-0-all",
-    # "sum-mc_CRY-I-1-all",
-    # "sum-mc_CRY-I-2-all",
-    # "sum-mc_CRY-I-3-all",
-    # "sum-mc_CRY-T-0-all",
-    # "sum-mc_CRY-T-1-all",
-    # "sum-mc_CRY-T-2-all",
-    # "sum-mc_CRY-T-3-all",
-    # "sum-mc_CRY-S-0-all",
-    # "sum-mc_CRY-S-1-all",
-    # "sum-mc_CRY-S-2-all",
-    # "sum-mc_CRY-S-3-all",
-    # "sum-D_mc_CRY-chi-1-all",
-    # "sum-D_mc_CRY-chi-2-all",
-    # "sum-D_mc_CRY-chi-3-all",
-    # "sum-D_mc_CRY-Z-1-all",
-    # "sum-D_mc_CRY-Z-2-all",
-    # "sum-D_mc_CRY-Z-3-all",
-    # "sum-D_mc_CRY-T-1-all",
-    # "sum-D_mc_CRY-T-2-all",
-    # "sum-D_mc_CRY-T-3-all",
-    # "sum-D_mc_CRY-S-1-all",
-    # "sum-D_mc_CRY-S-2-all",
-    # "sum-D_mc_CRY-S-3-all",
-]
+QUANTILES = ('median', '01', '09')
+RESULT_FIELDS = ['{}_{}'.format(field, quantile) for quantile in QUANTILES for field in ('rgb', 'hex', 'name')]
+
+# Features of structures we have already seen, keyed by the hash of the primitive structure
+FEATURE_CACHE = SQLiteLRUCache(
+    os.path.join(CACHE_DIR, 'features.sqlite'),
+    table='features',
+    max_entries=int(os.environ.get('MOFCOLORIZER_FEATURE_CACHE_SIZE', 10000)),
+    namespace='{}-{}'.format(FEATURIZER_VERSION, MODEL_VERSION),
+)
+
+# Predictions for feature vectors we have already seen (e.g. another cell or a supercell of the same structure),
+# keyed by prediction_key
+PREDICTION_CACHE = LRUCache(int(os.environ.get('MOFCOLORIZER_PREDICTION_CACHE_SIZE', 4096)))
+
+
+def __getattr__(name):
+    """The models are only loaded when they are accessed (e.g. core.MODEL_MEDIAN)"""
+    if name in MODEL_FILES:
+        return load_models()[name]
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
 
 
 def _featurize(cif):
-    """Runs featurization and returns none in case of FeaturizationException"""
+    """Runs featurization and returns the features as float64 vector in the order of CHEMICAL_FEATURES (None in case
+    of FeaturizationException), the error message and the reason why the structure was rejected before the
+    featurization (see validation.py, None if it was not)"""
     try:
-        descriptors = get_color_descriptors(cif)
-        return descriptors[CHEMICAL_FEATURES]
+        with timed('featurization'):
+            sprim = get_primitive_structure(cif)
+            with timed('feature_cache'):
+                key = structure_hash(sprim)
+                cached = FEATURE_CACHE.get(key)
+            if cached is not None:
+                return np.array(cached, dtype=np.float64), None, None
+            features = featurize_primitive_vector(sprim)
+            FEATURE_CACHE.set(key, features.tolist())
+            return features, None, None
+    except InvalidStructureException as execept:
+        print(execept)
+        return None, str(execept), execept.reason
     except FeaturizationException as execept:
         print(execept)
-        return None
+        return None, str(execept), None
+
+
+def featurize_stream(cifs, n_workers=1, timeout=None):
+    """Yields (index, features, error, invalid) for the cifs, see _featurize. With n_workers > 1 or a timeout (in
+    seconds per structure), the featurization runs in worker processes and the results come in the order in which
+    they finish"""
+    if n_workers == 1 and timeout is None:
+        for index, cif in enumerate(cifs):
+            features, error, invalid = _featurize(cif)
+            yield index, features, error, invalid
+        return
+
+    for index, result, error in imap_unordered(_featurize, cifs, n_workers, timeout):
+        features, error, invalid = result if error is None else (None, error, None)
+        yield index, features, error, invalid
+
+
+def prediction_key(features):
+    """Key of PREDICTION_CACHE for a float64 feature vector, the models are part of it"""
+    return hashlib.sha256(MODEL_VERSION.encode('utf-8') + np.ascontiguousarray(features).tobytes()).hexdigest()
+
+
+def predict_features(features):
+    """Predict the colors for a float array of features with shape (n, len(CHEMICAL_FEATURES)).
+    Returns one dict per row with RGB (0-255), hex and closest xkcd name for the median, 10 % and 90 % quantile
+    (e.g., rgb_median, hex_01, name_09), error and invalid (always None here). Rows that were predicted before come from
+    PREDICTION_CACHE."""
+    features = np.asarray(features, dtype=np.float64)
+    keys = [prediction_key(row) for row in features]
+    results = [PREDICTION_CACHE.get(key) for key in keys]
+    todo = [row for row, result in enumerate(results) if result is None]
+    if len(todo) < len(results):
+        increment('cache_hits', 'prediction', len(results) - len(todo))
+    if todo:
+        for row, result in zip(todo, _predict_features(features[todo])):
+            PREDICTION_CACHE.set(keys[row], result)
+            results[row] = result
+    # the cached RGB values are tuples, the callers get copies with lists which they can change
+    return [{field: list(value) if isinstance(value, tuple) else value for field, value in result.items()}
+            for result in results]
+
+
+def _predict_features(features):
+    results = [dict({field: None for field in RESULT_FIELDS}, error=None, invalid=None) for _ in range(len(features))]
+    if not results:
+        return results
+
+    # shape (n, 3, 3), the quantiles are in the same order as in QUANTILES
+    fused_predictions = load_fused_predictor()(features) * 255
+    # the predictions are truncated to integers, which is also what we show as RGB
+    rounded = fused_predictions.astype(int)
+    with timed('closest_name'):
+        names = lookup_names(rounded.reshape(-1, 3))
+
+    for row, result in enumerate(results):
+        for i, quantile in enumerate(QUANTILES):
+            rgb = tuple(int(c) for c in rounded[row, i])
+            result['rgb_' + quantile] = rgb
+            result['hex_' + quantile] = rgb_to_hex(rgb)
+            result['name_' + quantile] = names[row * len(QUANTILES) + i]
+
+    return results
+
+
+def predict_featurized(featurized):
+    """Predict the colors for a list of (features, error, invalid) tuples of featurize_stream, features is None if the
+    featurization failed. Returns one dict per entry as predict_features, with the featurization error (None if it
+    worked) and the reason why the structure is invalid (None if it is not)."""
+    results = [
+        dict({field: None for field in RESULT_FIELDS}, error=error, invalid=invalid) for _, error, invalid in featurized
+    ]
+
+    valid = [i for i, (features, _, _) in enumerate(featurized) if features is not None]
+    if valid:
+        features = np.stack([featurized[i][0] for i in valid])
+        for i, result in zip(valid, predict_features(features)):
+            results[i] = result
+
+    return results
+
+
+def predict_many(cifs, n_workers=1, timeout=None):
+    """Predict the colors for a list of cifs (paths or pymatgen Structures), see predict_featurized for the output.
+    With n_workers > 1, the featurization runs in parallel processes, timeout is in seconds per structure."""
+    cifs = list(cifs)
+    featurized = [None] * len(cifs)
+    for index, features, error, invalid in featurize_stream(cifs, n_workers, timeout):
+        featurized[index] = (features, error, invalid)
+    return predict_featurized(featurized)
 
 
 def predict(cif):
     """Outputs a table with predictions and a div with explanaition if the prediction worked"""
+    return render_prediction(predict_many([cif])[0])
 
-    features = _featurize(cif)
 
-    if not isinstance(features, pd.DataFrame):  # pylint:disable=no-else-return
+def render_prediction(result):
+    """Outputs a table for one result of predict_many, or an error message if the featurization failed"""
+    # results of jobs from before the invalid field have no such key
+    if result.get('invalid') is not None:  # pylint:disable=no-else-return
+        # rejected before the featurization, we know what is wrong with the structure
+        return dbc.Alert(
+            'The structure cannot be featurized: {}.'.format(result['invalid']),
+            dismissable=True,
+            color='warning',
+            style={
+                'margin-left': '3rem',
+                'margin-right': '1rem'
+            },
+        )
+    elif result['error'] is not None:
         # Featurization exception occured, we do not return a results table but rather an error message
         return dbc.Alert(
             'An error occured during the featurization. Ensure that your structure is valid, non-disordered and contains no clashing atoms.',
@@ -317,17 +188,6 @@ def predict(cif):
             },
         )
     else:
-        features = SCALER.transform(features)
-        prediction_01 = MODEL_01.predict(features) * 255
-        prediction_09 = MODEL_09.predict(features) * 255
-        prediction_median = MODEL_MEDIAN.predict(features) * 255
-
-        prediction_median_rounded = [int(c) for c in prediction_median[0]]
-        prediction_01_rounded = [int(c) for c in prediction_01[0]]
-        prediction_09_rounded = [int(c) for c in prediction_09[0]]
-        hex_median = [rgb_to_hex((int(c[0]), int(c[1]), int(c[2]))) for c in prediction_median][0]
-        hex_01 = [rgb_to_hex((int(c[0]), int(c[1]), int(c[2]))) for c in prediction_01][0]
-        hex_09 = [rgb_to_hex((int(c[0]), int(c[1]), int(c[2]))) for c in prediction_09][0]
         return html.Div([
             dbc.Table(
                 [
@@ -339,39 +199,27 @@ def predict(cif):
                     ]),
                     html.Tr([
                         html.Td('color'),
-                        html.Td(style={'background-color': hex_median}),
-                        html.Td(style={'background-color': hex_01}),
-                        html.Td(style={'background-color': hex_09}),
+                        html.Td(style={'background-color': result['hex_median']}),
+                        html.Td(style={'background-color': result['hex_01']}),
+                        html.Td(style={'background-color': result['hex_09']}),
                     ]),
                     html.Tr([
                         html.Td('RGB'),
-                        html.Td('{} {} {}'.format(
-                            prediction_median_rounded[0],
-                            prediction_median_rounded[1],
-                            prediction_median_rounded[2],
-                        )),
-                        html.Td('{} {} {}'.format(
-                            prediction_01_rounded[0],
-                            prediction_01_rounded[1],
-                            prediction_01_rounded[2],
-                        )),
-                        html.Td('{} {} {}'.format(
-                            prediction_09_rounded[0],
-                            prediction_09_rounded[1],
-                            prediction_09_rounded[2],
-                        )),
+                        html.Td('{} {} {}'.format(*result['rgb_median'])),
+                        html.Td('{} {} {}'.format(*result['rgb_01'])),
+                        html.Td('{} {} {}'.format(*result['rgb_09'])),
                     ]),
                     html.Tr([
                         html.Td('Hex'),
-                        html.Td(hex_median),
-                        html.Td(hex_01),
-                        html.Td(hex_09),
+                        html.Td(result['hex_median']),
+                        html.Td(result['hex_01']),
+                        html.Td(result['hex_09']),
                     ]),
                     html.Tr([
                         html.Td('Closest name from the xkcd survey'),
-                        html.Td(closest_name(prediction_median_rounded)),
-                        html.Td(closest_name(prediction_01_rounded)),
-                        html.Td(closest_name(prediction_09_rounded)),
+                        html.Td(result['name_median']),
+                        html.Td(result['name_01']),
+                        html.Td(result['name_09']),
                     ]),
                 ],
                 bordered=True,
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Columnar on-disk store for feature matrices, such that a database needs to be featurized only once.
+
+A store is a directory with
+    schema.json          the columns and the featurizer version
+    ids.txt              one structure id per row
+    columns/<i>.npy      one float64 .npy file per column, which can be memory-mapped
+
+Rows are appended in chunks. The ids are written last, they define how many rows are complete.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+
+import numpy as np
+
+from .featurize import FEATURIZER_VERSION
+
+# fixed size of the .npy headers, such that they can be rewritten in place when rows are appended
+_HEADER_SIZE = 128
+_DTYPE = np.dtype('<f8')
+
+
+def _write_header(handle, length):
+    header = np.lib.format.header_data_from_array_1_0(np.empty(0, dtype=_DTYPE))
+    header['shape'] = (length,)
+    text = repr(header).encode('latin1')
+    prefix = np.lib.format.magic(1, 0) + np.uint16(_HEADER_SIZE - 10).astype('<u2').tobytes()
+    padding = _HEADER_SIZE - len(prefix) - len(text) - 1
+    if padding < 0:
+        raise ValueError('Column too long for the header size')
+    handle.seek(0)
+    handle.write(prefix + text + b' ' * padding + b'\n')
+
+
+def _append_column(path, values, rows):
+    """Append values to the column file, dropping everything after the first rows (e.g. from an interrupted append)"""
+    if not os.path.exists(path):
+        with open(path, 'wb') as handle:
+            _write_header(handle, 0)
+    with open(path, 'r+b') as handle:
+        handle.truncate(_HEADER_SIZE + rows * _DTYPE.itemsize)
+        handle.seek(0, os.SEEK_END)
+        handle.write(np.ascontiguousarray(values, dtype=_DTYPE).tobytes())
+        _write_header(handle, rows + len(values))
+
+
+class FeatureStore:
+    """Feature matrix with one row per structure id, stored column by column"""
+
+    def __init__(self, path, columns=None):
+        """Opens the store at path. To create a new one, the columns need to be given"""
+        self.path = path
+        schema_path = os.path.join(path, 'schema.json')
+
+        if os.path.exists(schema_path):
+            with open(schema_path) as handle:
+                schema = json.load(handle)
+            if columns is not None and list(columns) != schema['columns']:
+                raise ValueError('The columns do not match the ones of the feature store {}'.format(path))
+            if schema['featurizer_version'] != FEATURIZER_VERSION:
+                raise ValueError('The feature store {} was created with featurizer version {}, this is {}'.format(
+                    path, schema['featurizer_version'], FEATURIZER_VERSION))
+            self.columns = schema['columns']
+        else:
+            if columns is None:
+                raise ValueError('{} is no feature store, provide the columns to create one'.format(path))
+            self.columns = list(columns)
+            os.makedirs(os.path.join(path, 'columns'), exist_ok=True)
+            with open(schema_path, 'w') as handle:
+                json.dump({'columns': self.columns, 'featurizer_version': FEATURIZER_VERSION}, handle)
+            open(self._ids_path, 'a').close()
+
+        self._column_index = {column: i for i, column in enumerate(self.columns)}
+
+    @property
+    def _ids_path(self):
+        return os.path.join(self.path, 'ids.txt')
+
+    def _column_path(self, column):
+        return os.path.join(self.path, 'columns', '{}.npy'.format(self._column_index[column]))
+
+    def ids(self):
+        """Ids of the complete rows, in order"""
+        with open(self._ids_path) as handle:
+            return [line.rstrip('\n') for line in handle]
+
+    def __len__(self):
+        count = 0
+        with open(self._ids_path, 'rb') as handle:
+            for block in iter(lambda: handle.read(1 << 20), b''):
+                count += block.count(b'\n')
+        return count
+
+    def append(self, ids, features):
+        """Append rows, features has shape (len(ids), len(columns)) with the columns in the order of the store"""
+        features = np.asarray(features, dtype=_DTYPE).reshape(len(ids), len(self.columns))
+        if any('\n' in structure_id for structure_id in ids):
+            raise ValueError('Ids must not contain newlines')
+        rows = len(self)
+        for column, values in zip(self.columns, features.T):
+            _append_column(self._column_path(column), values, rows)
+        with open(self._ids_path, 'a') as handle:
+            handle.writelines(structure_id + '\n' for structure_id in ids)
+
+    def column(self, column):
+        """Memory-mapped (read-only, no copy) values of one column"""
+        return self._column(column, len(self))
+
+    def _column(self, column, rows):
+        """Memory-mapped values of the first rows of one column"""
+        if rows == 0:
+            return np.empty(0, dtype=_DTYPE)
+        return np.load(self._column_path(column), mmap_mode='r')[:rows]
+
+    def matrix(self, columns=None, start=0, stop=None):
+        """Rows start to stop of the given columns (default: all) as one C-contiguous array, e.g. for the models"""
+        columns = self.columns if columns is None else columns
+        rows = len(self)
+        stop = rows if stop is None else min(stop, rows)
+        result = np.empty((max(stop - start, 0), len(columns)), dtype=_DTYPE)
+        for i, column in enumerate(columns):
+            result[:, i] = self._column(column, rows)[start:stop]
+        return result
+
+    def to_dataframe(self, columns=None):
+        """The store as pandas DataFrame indexed by the structure ids"""
+        import pandas as pd  # pylint:disable=import-outside-toplevel
+        columns = self.columns if columns is None else columns
+        ids = self.ids()
+        return pd.DataFrame({column: self._column(column, len(ids)) for column in columns}, index=ids, columns=columns)
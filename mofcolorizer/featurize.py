@@ -3,6 +3,8 @@
 """Featurization code. Copied from the colorml package to make the installation a bit less of a pain"""
 from __future__ import absolute_import, print_function
 
+import contextlib
+import logging
 import os
 from pathlib import Path
 
@@ -11,23 +13,126 @@ import openbabel as ob
 import pandas as pd
 import pybel
 from mofid.run_mofid import cif2mofid
+from pymatgen import Structure
 from pymatgen.io.cif import CifParser
 from six.moves import zip
 
 # This code relies on my fork of molsimplify which outputs the sum and the average RACs
+import molSimplify
+from molSimplify.Informatics.MOF import MOF_descriptors
 from molSimplify.Informatics.MOF.MOF_descriptors import get_MOF_descriptors
 
+from .cache import CACHE_DIR, SQLiteLRUCache
+from .metrics import timed
+from .schema import CHEMICAL_FEATURES, LINKER_COLUMNS, LINKER_FEATURES, check_features, rac_schema
+from .supervisor import Stage, StageError
 from .utils import make_temp_directory, temp
+from .validation import size_problem, structure_problem
+
+# Bump this whenever the featurization changes, it invalidates the cached features
+FEATURIZER_VERSION = '0.1'
+
+LOGGER = logging.getLogger(__name__)
+
+# Keys of get_molecular_descriptors, in the order in which they are returned
+MOLECULAR_DESCRIPTORS = [
+    'primary_amide',
+    'secondary_amide',
+    'tertiary_amide',
+    'ester',
+    'carbonyl',
+    'logP',
+    'MR',
+    'dbratio',
+    'aromatic_rings',
+    'dbonds',
+    'abonds',
+]
+
+# Deepest RACs the models use (e.g. mc_CRY-chi-3-all). molSimplify computes all families (mc, lc, func, f-lig)
+# up to this depth from the same connectivity graph in one call, and the models use all four of them
+RAC_DEPTH = 3
+
+
+def _skip(*args, **kwargs):  # pylint:disable=unused-argument
+    return None
+
+
+def _skip_sbu_racs(*args, **kwargs):  # pylint:disable=unused-argument
+    # a placeholder, molSimplify does not accept an empty list of RACs
+    return {'colnames': [['skipped']], 'results': [[0.0]]}
+
+
+# What get_MOF_descriptors computes besides the RACs of the models: the xyz and graph files of the cell, the SBUs and
+# the linkers, and the full scope RACs of the SBUs (f-sbu)
+RAC_SHORTCUTS = {
+    'writeXYZandGraph': _skip,
+    'XYZ_connected': _skip,
+    'generate_full_complex_autocorrelations': _skip_sbu_racs,
+}
+
+# consistency of the constants above with the columns of the models, what molSimplify returns is checked with
+# load_rac_schema
+check_features(MOLECULAR_DESCRIPTORS, RAC_DEPTH)
+
+# Small framework (DMOF-1, 54 atoms, primitive) whose RACs are computed at startup to compile the RACSchema
+SCHEMA_STRUCTURE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'schema_structure.cif')
+
+# Names of the descriptors molSimplify returns for SCHEMA_STRUCTURE, keyed by molsimplify_version
+RAC_NAMES_CACHE = SQLiteLRUCache(
+    os.path.join(CACHE_DIR, 'rac_names.sqlite'),
+    table='rac_names',
+    max_entries=16,
+    namespace=FEATURIZER_VERSION,
+)
+
+# Descriptors of linkers we have already seen, keyed by canonical SMILES and shared between processes
+LINKER_CACHE = SQLiteLRUCache(
+    os.path.join(CACHE_DIR, 'linkers.sqlite'),
+    table='linkers',
+    max_entries=int(os.environ.get('MOFCOLORIZER_LINKER_CACHE_SIZE', 100000)),
+    namespace=FEATURIZER_VERSION,
+)
 
 
 class FeaturizationException(Exception):
     pass
 
 
+class InvalidStructureException(FeaturizationException):
+    """The structure was rejected by the checks before the featurization"""
+
+    PREFIX = 'Invalid structure: '
+
+    def __init__(self, reason):
+        super().__init__(self.PREFIX + reason)
+        self.reason = reason
+
+
+def get_primitive_structure(datapath):
+    """Parse the cif and return the primitive structure. Also accepts a pymatgen Structure instead of a path.
+    Raises InvalidStructureException for structures that cannot be featurized (e.g. disordered or clashing)"""
+    try:
+        with timed('primitive'):
+            if isinstance(datapath, Structure):
+                s = datapath  # pylint:disable=invalid-name
+            else:
+                s = CifParser(datapath, occupancy_tolerance=1).get_structures()[0]  # pylint:disable=invalid-name
+            with timed('validation'):
+                problem = structure_problem(s)
+            if problem is None:
+                s = s.get_primitive_structure()  # pylint:disable=invalid-name
+                problem = size_problem(s)
+    except Exception as e:  # pylint:disable=invalid-name
+        raise FeaturizationException('Could not featurize the structure due to  {}'.format(e))
+    if problem is not None:
+        raise InvalidStructureException(problem)
+    return s
+
+
 def get_primitive(datapath, writepath):
     """Generate primitive structure which is needed for molsimplify"""
-    s = CifParser(datapath, occupancy_tolerance=1).get_structures()[0]  # pylint:disable=invalid-name
-    sprim = s.get_primitive_structure()
+    sprim = get_primitive_structure(datapath)
     sprim.to('cif', writepath)
 
 
@@ -100,8 +205,11 @@ def get_group_counts(mol):
 
 def get_molecular_descriptors(smiles):
     """get heuristics from strings using openbabel"""
-    mymol = pybel.readstring('smi', smiles)
+    return _get_molecular_descriptors(pybel.readstring('smi', smiles))
+
 
+def _get_molecular_descriptors(mymol):
+    """get heuristics from a pybel molecule"""
     descriptordict = {}
 
     group_counts = get_group_counts(mymol)
@@ -120,22 +228,40 @@ def get_molecular_descriptors(smiles):
     return descriptordict
 
 
+def get_linker_descriptors(smiles):
+    """Values of get_molecular_descriptors (in the order of MOLECULAR_DESCRIPTORS) with a persistent cache keyed by
+    the canonical SMILES. It runs in a new mofid stage process for every structure, a cache in memory would be lost"""
+    mymol = pybel.readstring('smi', smiles)
+    canonical_smiles = mymol.write('can').split()[0]
+
+    descriptors = LINKER_CACHE.get(canonical_smiles)
+    if descriptors is None:
+        descriptordict = _get_molecular_descriptors(mymol)
+        descriptors = [descriptordict[key] for key in MOLECULAR_DESCRIPTORS]
+        LINKER_CACHE.set(canonical_smiles, descriptors)
+
+    return tuple(descriptors)
+
+
 def get_smiles_features(cif):
     """Use openbabel to calculate some features based on the smiles which we get from MOFid"""
     # make sure that the output is automatically deleted.
-    with make_temp_directory() as temp_dir:
+    with make_temp_directory() as temp_dir, timed('mofid'):
         mofid = cif2mofid(cif, temp_dir)
     name = mofid['cifname']
 
     linker_descriptors = []
 
     try:
-        for linker in mofid['smiles_linkers']:
-            linker_descriptors.append(list(get_molecular_descriptors(linker).values()))
-            # super inefficient to do this all the time. But i do not know if i'll change the descriptorlist ...
-            keys = list(get_molecular_descriptors(linker).keys())
-            mean_keys = [s + '_mean' for s in keys]
-            sum_keys = [s + '_sum' for s in keys]
+        with timed('linker_descriptors'):
+            for linker in mofid['smiles_linkers']:
+                linker_descriptors.append(get_linker_descriptors(linker))
+
+        if not linker_descriptors:
+            raise ValueError('MOFid did not find any linker')
+
+        mean_keys = [s + '_mean' for s in MOLECULAR_DESCRIPTORS]
+        sum_keys = [s + '_sum' for s in MOLECULAR_DESCRIPTORS]
 
         linker_descriptors = np.array(linker_descriptors)
         means = np.mean(linker_descriptors, axis=0)
@@ -170,53 +296,141 @@ def get_moldesc(cifs):
     return df
 
 
-def get_racs(cif):
-    """Assumes that cif is primitive. As there is no way in molsimplify to stop writing stuff, we do it in some temporary directory"""
-    featurization_list = []
-    # need to catch and handle exceptions
+def _failure_reason(path):
+    try:
+        with open(os.path.join(path, 'FailedStructures.log')) as handle:
+            return handle.read().strip() or 'unknown reason'
+    except OSError:
+        return 'unknown reason'
 
+
+@contextlib.contextmanager
+def _model_racs_only():
+    """Replaces the functions in RAC_SHORTCUTS in molSimplify, e.g. for one call of get_MOF_descriptors"""
+    originals = {name: getattr(MOF_descriptors, name) for name in RAC_SHORTCUTS if hasattr(MOF_descriptors, name)}
+    try:
+        for name in originals:
+            setattr(MOF_descriptors, name, RAC_SHORTCUTS[name])
+        yield
+    finally:
+        for name, func in originals.items():
+            setattr(MOF_descriptors, name, func)
+
+
+def get_rac_descriptors(cif):
+    """Names and values of the descriptors molSimplify computes for the (primitive) cif, see RACSchema. Skips the
+    files and RACs in RAC_SHORTCUTS, molSimplify still writes logs and csv files, we do it in some temporary
+    directory"""
     with make_temp_directory() as temp_dir:
-        full_names, full_descriptors = get_MOF_descriptors(
-            cif,  # inputstructure
-            3,  # scope
-            path=temp_dir,  # stuff will be dumped here
-            xyzpath=os.path.join(temp_dir, 'file.xyz'),
-        )
-        full_names.append('filename')
-        full_descriptors.append(Path(cif).stem)
-        featurization = dict(zip(full_names, full_descriptors))
-        featurization_list.append(featurization)
-
-    df = pd.DataFrame(featurization_list)  # pylint:disable=invalid-name
-    keep = [val for val in df.columns.values if ('mc' in val) or ('lc' in val) or ('f-lig' in val) or ('func' in val)]
-    df = df[['filename'] + keep]  # pylint:disable=invalid-name
-
-    # Now, we need to employ a workaround because the feature names changed mc_CR -> mc with open sourcing the MOF RACs code
-    mc_features = [val for val in df.columns.values if 'mc' in val]
-    # if we use the old version, all should have CRY in name, in the new version no feature should have CRY in name
-    if not 'CRY' in mc_features[0]:
-        mc_features_new = [val.replace('mc', 'mc_CRY') for val in mc_features]
-        replacement_dict = dict(zip(mc_features, mc_features_new))
-        df.rename(columns=replacement_dict, inplace=True)
-    # need to generate sums and differences
-    return df
+        with timed('racs'), _model_racs_only():
+            full_names, full_descriptors = get_MOF_descriptors(
+                cif,  # inputstructure
+                RAC_DEPTH,  # scope
+                path=temp_dir,  # stuff will be dumped here
+                xyzpath=os.path.join(temp_dir, 'file.xyz'),
+            )
+        if full_names == [0]:
+            # molSimplify does not raise, but returns a placeholder and writes the reason into a log
+            raise ValueError('molSimplify could not compute the RACs: {}'.format(_failure_reason(temp_dir)))
+    return tuple(full_names), list(full_descriptors)
+
+
+def molsimplify_version():
+    """Version of the installed molSimplify, with the modification time of its MOF code (forks installed from git
+    often keep the version)"""
+    version = getattr(molSimplify, '__version__', None)
+    if version is None:
+        import pkg_resources  # pylint:disable=import-outside-toplevel
+        try:
+            version = pkg_resources.get_distribution('molSimplify').version
+        except pkg_resources.DistributionNotFound:
+            version = 'unknown'
+    return '{}-{:.0f}'.format(version, os.path.getmtime(MOF_descriptors.__file__))
+
+
+def load_rac_schema(cif=SCHEMA_STRUCTURE):
+    """Compile the RACSchema for the names the installed molSimplify returns, raises SchemaMismatch if they do not
+    provide the RACs of the models. The names come from the RACs of a bundled structure, which are computed once per
+    molsimplify_version. Called at startup (e.g. in gunicorn's when_ready), the processes forked afterwards use the
+    compiled schema. Returns None if molSimplify fails on the structure, the schema is then compiled for the first
+    structure that is featurized"""
+    version = molsimplify_version()
+    names = RAC_NAMES_CACHE.get(version)
+    if names is None:
+        try:
+            names, _ = Stage('racs', get_rac_descriptors, cif).result()
+        except StageError as e:  # pylint:disable=invalid-name
+            LOGGER.warning('Could not compute the RACs of %s to check the RAC schema: %s', cif, e)
+            return None
+        RAC_NAMES_CACHE.set(version, list(names))
+    return rac_schema(tuple(names))
+
+
+def get_racs(cif):
+    """Assumes that cif is primitive. All RACs (with the names of the models) as DataFrame with a filename column"""
+    names, descriptors = get_rac_descriptors(cif)
+    return pd.DataFrame([dict(filename=Path(cif).stem, **rac_schema(names).to_dict(descriptors))])
 
 
 def merge_racs_moldesc(df_moldesc, df_racs):
     """Merge df assuming that the filename columns are filename and racs"""
-    df_merged = pd.merge(df_racs, df_moldesc, left_on='filename', right_on='name')
+    with timed('merge'):
+        df_merged = pd.merge(df_racs, df_moldesc, left_on='filename', right_on='name')
     return df_merged
 
 
-def get_color_descriptors(cif):
-    """Orchestrate the featurization"""
+def _run_stages(sprim):
+    """RACs (names and values) and linker descriptors (dict) of a primitive pymatgen Structure.
+    MOFid and molSimplify need a file, it is written once (to /dev/shm if available) and read by both"""
+    with temp() as tempfile:
+        tempname = tempfile.name
+        sprim.to('cif', tempname)
+        # Both stages run at the same time in supervised processes (see supervisor.py), the latency is then
+        # the one of the slower of both. If one fails, the other one is stopped before the file is removed.
+        moldesc_stage = Stage('mofid', get_smiles_features, tempname)
+        racs_stage = Stage('racs', get_rac_descriptors, tempname)
+        try:
+            racs = racs_stage.result()
+            moldesc = moldesc_stage.result()
+        finally:
+            racs_stage.stop()
+            moldesc_stage.stop()
+    if moldesc is None:
+        raise ValueError('Could not compute the linker descriptors')
+    return racs, moldesc
+
+
+def assemble_features(racs, moldesc):
+    """Float64 vector of the features in the order of CHEMICAL_FEATURES from the (names, values) of
+    get_rac_descriptors and the dict of get_smiles_features"""
+    with timed('assemble'):
+        features = np.empty(len(CHEMICAL_FEATURES))
+        rac_schema(racs[0]).gather(racs[1], features)
+        features[LINKER_COLUMNS] = [moldesc[name] for name in LINKER_FEATURES]
+    return features
+
+
+def featurize_primitive_vector(sprim):
+    """Features of a primitive pymatgen Structure as float64 vector in the order of CHEMICAL_FEATURES"""
     try:
-        with temp() as tempfile:
-            tempname = tempfile.name
-            get_primitive(cif, tempname)
-            moldesc = get_moldesc([tempname])
-            racs = get_racs(tempname)
-        df_features = merge_racs_moldesc(moldesc, racs)
+        return assemble_features(*_run_stages(sprim))
+    except Exception as e:  # pylint:disable=invalid-name
+        raise FeaturizationException('Could not featurize the structure due to  {}'.format(e))
+
+
+def featurize_primitive(sprim):
+    """Run the featurization for a primitive pymatgen Structure, returns all descriptors as DataFrame (e.g. to export
+    them). For the features of the models, featurize_primitive_vector avoids the DataFrames"""
+    try:
+        (names, descriptors), moldesc = _run_stages(sprim)
+        df_racs = pd.DataFrame([dict(filename=moldesc['name'], **rac_schema(names).to_dict(descriptors))])
+        df_features = merge_racs_moldesc(pd.DataFrame([moldesc]), df_racs)
         return df_features
     except Exception as e:  # pylint:disable=invalid-name
         raise FeaturizationException('Could not featurize the structure due to  {}'.format(e))
+
+
+def get_color_descriptors(cif):
+    """Orchestrate the featurization, cif can be a path or a pymatgen Structure"""
+    with timed('featurization'):
+        return featurize_primitive(get_primitive_structure(cif))
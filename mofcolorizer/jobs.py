@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Background jobs such that the predictions do not block the web workers"""
+from __future__ import absolute_import
+
+import math
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import CACHE_DIR, SQLiteLRUCache
+
+JOB_WORKERS = int(os.environ.get('MOFCOLORIZER_JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('MOFCOLORIZER_JOB_QUEUE_SIZE', 8))
+JOB_TIMEOUT = float(os.environ.get('MOFCOLORIZER_JOB_TIMEOUT', 600))
+# on top of the longest time a job can be pending or running, after which it is reported as failed (e.g. when the
+# worker process that ran it was restarted, the job would stay running in the store forever)
+JOB_STALE_MARGIN = 60
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    """Runs functions in a pool of background threads and keeps the status and the (JSON serializable) result
+    in a store that is shared by all processes, so any web worker can answer the poll for a job.
+    At most max_pending jobs (queued or running) are accepted per process, submit raises QueueFullError beyond.
+    The functions need to return within timeout seconds, jobs that take longer are reported as failed."""
+
+    def __init__(self, store, max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE, timeout=JOB_TIMEOUT):
+        self.store = store
+        self.max_workers = max_workers
+        # a job waits for at most all jobs before it in the queue
+        self.max_age = {
+            PENDING: timeout * math.ceil(max_pending / max_workers) + JOB_STALE_MARGIN,
+            RUNNING: timeout + JOB_STALE_MARGIN,
+        }
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # created on first use, threads do not survive the fork of preloading gunicorn workers
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def submit(self, func, *args):
+        """Schedule func(*args) and return the job id"""
+        if not self._slots.acquire(blocking=False):  # pylint:disable=consider-using-with
+            raise QueueFullError('There are already too many jobs in the queue')
+
+        job_id = uuid.uuid4().hex
+        self._set(job_id, PENDING)
+        try:
+            self._get_executor().submit(self._run, job_id, func, args)
+        except Exception:
+            self._slots.release()
+            raise
+        return job_id
+
+    def reserve(self):
+        """Take a slot for work that runs outside of the queue (e.g. a streamed API request), such that it counts
+        towards max_pending. Raises QueueFullError if there is none, returns the function that releases it"""
+        if not self._slots.acquire(blocking=False):  # pylint:disable=consider-using-with
+            raise QueueFullError('There are already too many jobs in the queue')
+        return self._slots.release
+
+    def _set(self, job_id, status, result=None, error=None):
+        self.store.set(job_id, {'status': status, 'result': result, 'error': error, 'since': time.time()})
+
+    def _run(self, job_id, func, args):
+        try:
+            self._set(job_id, RUNNING)
+            result = func(*args)
+            self._set(job_id, DONE, result=result)
+        except Exception as e:  # pylint:disable=broad-except,invalid-name
+            self._set(job_id, FAILED, error=str(e))
+        finally:
+            self._slots.release()
+
+    def status(self, job_id):
+        """Return a dict with status, result and error of the job, or None if the job is unknown. Jobs that are
+        pending or running for longer than they can are failed"""
+        job = self.store.get(job_id)
+        if job is not None and job['status'] in self.max_age:
+            # jobs stored before the since field were submitted before the last restart
+            if time.time() - job.get('since', 0) > self.max_age[job['status']]:
+                return {'status': FAILED, 'result': None, 'error': 'The job was lost, e.g. in a restart of the server'}
+        return job
+
+
+JOB_QUEUE = JobQueue(SQLiteLRUCache(os.path.join(CACHE_DIR, 'jobs.sqlite'), table='jobs', max_entries=1000))
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Timings of the featurization and prediction stages, as histograms in the Prometheus text format.
+
+Every process keeps its own histograms. After enable_persistence (the app does this in gunicorn's when_ready),
+the processes write them to METRICS_DIR/<pid>.json every FLUSH_INTERVAL seconds and at exit, and the metrics
+endpoint adds up the files of all processes (e.g. all gunicorn workers). enable_persistence removes the files of
+processes that no longer run, e.g. of a previous deployment. Worker processes of parallel.imap_unordered do not
+write files but send their observations back to the parent.
+"""
+from __future__ import absolute_import
+
+import atexit
+import contextlib
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from .cache import CACHE_DIR
+
+METRICS_DIR = os.environ.get('MOFCOLORIZER_METRICS_DIR', os.path.join(CACHE_DIR, 'metrics'))
+# seconds between two writes of the metrics of a process
+FLUSH_INTERVAL = float(os.environ.get('MOFCOLORIZER_METRICS_FLUSH_INTERVAL', 5))
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+LOGGER = logging.getLogger(__name__)
+
+_LOCK = threading.Lock()
+_STATE = {'histograms': {}, 'counters': {}}
+_PERSIST = False
+_DIRTY = False
+_FLUSHER_PID = None  # process in which the flush thread runs
+
+
+def _empty_histogram():
+    return {'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+
+
+def _path(pid):
+    return os.path.join(METRICS_DIR, '{}.json'.format(pid))
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # runs, but as another user
+    return True
+
+
+def _remove_stale_files():
+    """Remove the files of processes that no longer run"""
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        try:
+            pid = int(os.path.splitext(os.path.basename(path))[0])
+        except ValueError:
+            continue
+        if not _is_running(pid):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def enable_persistence():
+    """Called once at startup (before forking workers): this process and the ones forked from it write their
+    metrics to METRICS_DIR. Removes the files of processes that no longer run"""
+    global _PERSIST  # pylint:disable=global-statement
+    _remove_stale_files()
+    with _LOCK:
+        _PERSIST = True
+    atexit.register(flush)
+
+
+def _mark_dirty():
+    """Expects the lock to be held, starts the flush thread of this process if needed"""
+    global _DIRTY, _FLUSHER_PID  # pylint:disable=global-statement
+    if not _PERSIST:
+        return
+    _DIRTY = True
+    if _FLUSHER_PID != os.getpid():
+        _FLUSHER_PID = os.getpid()
+        threading.Thread(target=_flush_periodically, name='metrics-flush', daemon=True).start()
+
+
+def _flush_periodically():
+    pid = os.getpid()
+    while _FLUSHER_PID == pid:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+
+def flush():
+    """Write the metrics of this process to its file if they changed"""
+    global _DIRTY  # pylint:disable=global-statement
+    with _LOCK:
+        if not (_PERSIST and _DIRTY):
+            return
+        _save()
+        _DIRTY = False
+
+
+def _save():
+    """Write the state of this process to its file, expects the lock to be held"""
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = _path(os.getpid())
+        with open(path + '.tmp', 'w') as handle:
+            json.dump(_STATE, handle)
+        os.replace(path + '.tmp', path)
+    except OSError as e:  # pylint:disable=invalid-name
+        LOGGER.warning('Could not write the metrics: %s', e)
+
+
+def observe(stage, seconds):
+    """Record the duration of one run of a stage"""
+    with _LOCK:
+        histogram = _STATE['histograms'].setdefault(stage, _empty_histogram())
+        bucket = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+        histogram['buckets'][bucket] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+        _mark_dirty()
+
+
+def increment(counter, stage, value=1):
+    """Increase a counter (e.g. timeouts) of a stage"""
+    with _LOCK:
+        counters = _STATE['counters'].setdefault(counter, {})
+        counters[stage] = counters.get(stage, 0) + value
+        _mark_dirty()
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """Contextmanager that records the wall time of the block as one observation of stage and logs it"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        observe(stage, duration)
+        LOGGER.info('stage %s took %.3f s', stage, duration, extra={'stage': stage, 'duration': duration})
+
+
+def snapshot():
+    """Copy of the metrics of this process"""
+    with _LOCK:
+        return json.loads(json.dumps(_STATE))
+
+
+def merge(other):
+    """Add the metrics of a snapshot (e.g. from a worker process) to the ones of this process"""
+    with _LOCK:
+        _merge_into(_STATE, other)
+        _mark_dirty()
+
+
+def _merge_into(state, other):
+    for stage, histogram in other['histograms'].items():
+        target = state['histograms'].setdefault(stage, _empty_histogram())
+        target['buckets'] = [a + b for a, b in zip(target['buckets'], histogram['buckets'])]
+        target['sum'] += histogram['sum']
+        target['count'] += histogram['count']
+    for counter, stages in other['counters'].items():
+        target = state['counters'].setdefault(counter, {})
+        for stage, value in stages.items():
+            target[stage] = target.get(stage, 0) + value
+
+
+def start_child():
+    """Called in worker processes, which report their metrics to the parent instead of writing them"""
+    global _PERSIST  # pylint:disable=global-statement
+    with _LOCK:
+        _PERSIST = False
+        _STATE['histograms'] = {}
+        _STATE['counters'] = {}
+
+
+def _after_fork():
+    """A forked process starts with its own metrics (the ones of the parent are in the parent's file) and a new
+    lock, the one of the parent can be held by one of its other threads at the time of the fork"""
+    global _LOCK, _STATE, _DIRTY, _FLUSHER_PID  # pylint:disable=global-statement
+    _LOCK = threading.Lock()
+    _STATE = {'histograms': {}, 'counters': {}}
+    _DIRTY = False
+    _FLUSHER_PID = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _collect():
+    """Metrics of all processes that wrote to METRICS_DIR (and of this one)"""
+    state = {'histograms': {}, 'counters': {}}
+    paths = glob.glob(os.path.join(METRICS_DIR, '*.json')) if _PERSIST else []
+    own_path = _path(os.getpid())
+    for path in paths:
+        if path == own_path:
+            continue
+        try:
+            with open(path) as handle:
+                _merge_into(state, json.load(handle))
+        except (OSError, ValueError):
+            continue  # e.g. removed in the meantime
+    _merge_into(state, snapshot())
+    return state
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format"""
+    state = _collect()
+    lines = [
+        '# HELP mofcolorizer_stage_duration_seconds Wall time of the featurization and prediction stages',
+        '# TYPE mofcolorizer_stage_duration_seconds histogram',
+    ]
+    for stage, histogram in sorted(state['histograms'].items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram['buckets']):
+            cumulative += count
+            lines.append('mofcolorizer_stage_duration_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                stage, bound, cumulative))
+        lines.append('mofcolorizer_stage_duration_seconds_sum{{stage="{}"}} {}'.format(stage, histogram['sum']))
+        lines.append('mofcolorizer_stage_duration_seconds_count{{stage="{}"}} {}'.format(stage, histogram['count']))
+    for counter, stages in sorted(state['counters'].items()):
+        lines.append('# TYPE mofcolorizer_{}_total counter'.format(counter))
+        for stage, value in sorted(stages.items()):
+            lines.append('mofcolorizer_{}_total{{stage="{}"}} {}'.format(counter, stage, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Loads the scaler and the quantile regressors once per process, on first use"""
+from __future__ import absolute_import
+
+import os
+import threading
+
+import joblib
+import numpy as np
+
+from .metrics import timed
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+MODEL_VERSION = 'run_2020_09_10_13_19_1599736778'
+
+MODEL_FILES = {
+    'SCALER': 'scaler_{}.joblib'.format(MODEL_VERSION),
+    'MODEL_MEDIAN': 'regressor_median{}False.joblib'.format(MODEL_VERSION),
+    'MODEL_01': 'regressor_0_1{}False.joblib'.format(MODEL_VERSION),
+    'MODEL_09': 'regressor_0_9{}False.joblib'.format(MODEL_VERSION),
+}
+
+# e.g. 'r' to memory-map the numpy arrays in the joblib files, they are then shared via the page cache
+MMAP_MODE = os.environ.get('MOFCOLORIZER_MMAP_MODE') or None
+
+# order of the quantiles along axis 1 of the output of FusedPredictor
+QUANTILE_MODELS = ('MODEL_MEDIAN', 'MODEL_01', 'MODEL_09')
+
+_MODELS = None
+_FUSED_PREDICTOR = None
+_LOCK = threading.Lock()
+
+
+def load_models(mmap_mode=MMAP_MODE):
+    """Returns a dict with SCALER, MODEL_MEDIAN, MODEL_01 and MODEL_09, loading them if this did not happen yet.
+    Call this in the gunicorn master (with preload_app) to share the models copy-on-write with all workers"""
+    global _MODELS  # pylint:disable=global-statement
+    if _MODELS is None:
+        with _LOCK:
+            if _MODELS is None:
+                _MODELS = {
+                    name: joblib.load(os.path.join(THIS_DIR, filename), mmap_mode=mmap_mode)
+                    for name, filename in MODEL_FILES.items()
+                }
+    return _MODELS
+
+
+def _output_predictors(model):
+    """One predict function per output (color channel) for MultiOutputRegressors of LightGBM models, calling the
+    booster directly skips the input validation of the sklearn wrappers. None if the model is something else."""
+    estimators = getattr(model, 'estimators_', None)
+    if estimators is None:
+        return None
+    predictors = []
+    for estimator in estimators:
+        booster = getattr(estimator, 'booster_', None)
+        predictors.append(booster.predict if booster is not None else estimator.predict)
+    return predictors
+
+
+class FusedPredictor:
+    """Scaling and all three quantile models in one call on a float64 array in CHEMICAL_FEATURES order.
+    Returns the predictions (0-1) with shape (n, 3, 3): structure, quantile (as in QUANTILE_MODELS), channel."""
+
+    def __init__(self, models):
+        scaler = models['SCALER']
+        self._scaler = scaler
+        # StandardScalers are applied in place, with the same operations as in scaler.transform
+        self._mean = getattr(scaler, 'mean_', None) if getattr(scaler, 'with_mean', False) else None
+        self._scale = getattr(scaler, 'scale_', None) if getattr(scaler, 'with_std', False) else None
+        self._fold_scaler = hasattr(scaler, 'with_mean') and hasattr(scaler, 'with_std')
+
+        self._models = [models[name] for name in QUANTILE_MODELS]
+        self._predictors = [_output_predictors(model) for model in self._models]
+
+    def __call__(self, features):
+        features = np.array(features, dtype=np.float64, order='C')
+        if features.ndim == 1:
+            features = features[np.newaxis, :]
+
+        with timed('scaling'):
+            if self._fold_scaler:
+                if self._mean is not None:
+                    features -= self._mean
+                if self._scale is not None:
+                    features /= self._scale
+            else:
+                features = self._scaler.transform(features)
+
+        result = np.empty((len(features), len(self._models), 3))
+        with timed('inference'):
+            for quantile, (model, predictors) in enumerate(zip(self._models, self._predictors)):
+                if predictors is None:
+                    result[:, quantile, :] = model.predict(features)
+                else:
+                    for channel, predictor in enumerate(predictors):
+                        result[:, quantile, channel] = predictor(features)
+        return result
+
+
+def load_fused_predictor():
+    """FusedPredictor for the models of load_models, created once per process"""
+    global _FUSED_PREDICTOR  # pylint:disable=global-statement
+    if _FUSED_PREDICTOR is None:
+        models = load_models()
+        with _LOCK:
+            if _FUSED_PREDICTOR is None:
+                _FUSED_PREDICTOR = FusedPredictor(models)
+    return _FUSED_PREDICTOR
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Runs the featurization of many structures in worker processes"""
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+
+from . import metrics, supervisor
+
+DEFAULT_WORKERS = int(os.environ.get('MOFCOLORIZER_WORKERS', os.cpu_count() or 1))
+
+
+def _run_child(connection, func, item):
+    """Entry point of the worker process, sends (True, result, metrics) or (False, error message, metrics) to the
+    parent"""
+    metrics.start_child()
+    supervisor.stop_stages_on_sigterm()
+    try:
+        result = func(item)
+        connection.send((True, result, metrics.snapshot()))
+    except Exception as e:  # pylint:disable=broad-except,invalid-name
+        connection.send((False, '{}: {}'.format(type(e).__name__, e), metrics.snapshot()))
+    finally:
+        connection.close()
+
+
+def _stop(connection, process):
+    # SIGTERM, the worker then kills its featurization stages (see supervisor.stop_stages_on_sigterm)
+    process.terminate()
+    process.join()
+    connection.close()
+
+
+def imap_unordered(func, items, n_workers=None, timeout=None):
+    """Calls func(item) for all items, each in its own process with at most n_workers processes at the same time.
+    Yields (index, result, error) as soon as an item is done, error is None if func succeeded.
+    Exceptions, crashes of the worker and timeouts (in seconds per item) only fail the affected item.
+    A process per item instead of a pool of long-lived workers: a timed-out item is stopped by killing its process,
+    which a pool would need to replace as well, and the memory of the featurization is returned after every item.
+    The fork takes milliseconds (the parent's memory is shared copy-on-write), an item seconds to minutes.
+    The fork happens in a process with threads (e.g. a gthread gunicorn worker): the metrics and logging renew their
+    locks in the child and the caches open a new SQLite connection per call, but a lock inside a C library that
+    another thread held at the time of the fork would block the child until its timeout. A pool would be forked from
+    the same process and have the same problem."""
+    n_workers = max(1, n_workers or DEFAULT_WORKERS)
+    pending = enumerate(items)
+    running = {}  # connection -> (index, process, deadline)
+
+    try:
+        while True:
+            while len(running) < n_workers:
+                try:
+                    index, item = next(pending)
+                except StopIteration:
+                    break
+                parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=_run_child, args=(child_connection, func, item))
+                process.start()
+                child_connection.close()
+                deadline = time.monotonic() + timeout if timeout else None
+                running[parent_connection] = (index, process, deadline)
+
+            if not running:
+                return
+
+            deadlines = [deadline for _, _, deadline in running.values() if deadline is not None]
+            wait_time = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+
+            for connection in wait(list(running), timeout=wait_time):
+                index, process, _ = running.pop(connection)
+                try:
+                    success, payload, child_metrics = connection.recv()
+                    metrics.merge(child_metrics)
+                except EOFError:
+                    process.join()
+                    success, payload = False, 'worker exited with code {}'.format(process.exitcode)
+                connection.close()
+                process.join()
+                yield index, (payload if success else None), (None if success else payload)
+
+            now = time.monotonic()
+            for connection, (index, process, deadline) in list(running.items()):
+                if deadline is not None and deadline <= now:
+                    del running[connection]
+                    _stop(connection, process)
+                    metrics.increment('timeouts', 'featurization')
+                    yield index, None, 'timed out after {} s'.format(timeout)
+    finally:
+        # e.g. if the consumer stops iterating early
+        for connection, (_, process, _) in running.items():
+            _stop(connection, process)
+
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""The features of the models, in the order in which the models expect them, and where they come from.
+
+The RACs are looked up in the output of molSimplify with a RACSchema, which is compiled once for the list of names
+molSimplify returns (i.e., once per molSimplify version) and fails if the models need RACs that are not in it.
+featurize.load_rac_schema compiles it at startup, for the names molSimplify returns for a bundled structure (computed
+once per molSimplify version and kept in the cache directory).
+"""
+from __future__ import absolute_import
+
+import functools
+
+import numpy as np
+
+CHEMICAL_FEATURES = [
+    'mc_CRY-chi-0-all',
+    'mc_CRY-chi-1-all',
+    'mc_CRY-chi-2-all',
+    'mc_CRY-chi-3-all',
+    'mc_CRY-Z-0-all',
+    'mc_CRY-Z-1-all',
+    'mc_CRY-Z-2-all',
+    'mc_CRY-Z-3-all',
+    'mc_CRY-I-1-all',
+    'mc_CRY-I-2-all',
+    'mc_CRY-I-3-all',
+    'mc_CRY-T-0-all',
+    'mc_CRY-T-1-all',
+    'mc_CRY-T-2-all',
+    'mc_CRY-T-3-all',
+    'mc_CRY-S-0-all',
+    'mc_CRY-S-1-all',
+    'mc_CRY-S-2-all',
+    'mc_CRY-S-3-all',
+    'D_mc_CRY-chi-1-all',
+    'D_mc_CRY-chi-2-all',
+    'D_mc_CRY-chi-3-all',
+    'D_mc_CRY-Z-1-all',
+    'D_mc_CRY-Z-2-all',
+    'D_mc_CRY-Z-3-all',
+    'D_mc_CRY-T-1-all',
+    'D_mc_CRY-T-2-all',
+    'D_mc_CRY-T-3-all',
+    'D_mc_CRY-S-1-all',
+    'D_mc_CRY-S-2-all',
+    'D_mc_CRY-S-3-all',
+    'func-chi-0-all',
+    'func-chi-1-all',
+    'func-chi-2-all',
+    'func-chi-3-all',
+    'func-Z-0-all',
+    'func-Z-1-all',
+    'func-Z-2-all',
+    'func-Z-3-all',
+    'func-I-1-all',
+    'func-I-2-all',
+    'func-I-3-all',
+    'func-T-0-all',
+    'func-T-1-all',
+    'func-T-2-all',
+    'func-T-3-all',
+    'func-S-0-all',
+    'func-S-1-all',
+    'func-S-2-all',
+    'func-S-3-all',
+    'func-alpha-0-all',
+    'func-alpha-1-all',
+    'func-alpha-2-all',
+    'func-alpha-3-all',
+    'D_func-chi-1-all',
+    'D_func-chi-2-all',
+    'D_func-chi-3-all',
+    'D_func-Z-1-all',
+    'D_func-Z-2-all',
+    'D_func-Z-3-all',
+    'D_func-T-1-all',
+    'D_func-T-2-all',
+    'D_func-T-3-all',
+    'D_func-S-2-all',
+    'D_func-S-3-all',
+    'D_func-alpha-1-all',
+    'D_func-alpha-2-all',
+    'D_func-alpha-3-all',
+    'f-lig-chi-0',
+    'f-lig-chi-1',
+    'f-lig-chi-2',
+    'f-lig-chi-3',
+    'f-lig-Z-0',
+    'f-lig-Z-1',
+    'f-lig-Z-2',
+    'f-lig-Z-3',
+    'f-lig-I-0',
+    'f-lig-I-1',
+    'f-lig-I-2',
+    'f-lig-I-3',
+    'f-lig-T-0',
+    'f-lig-T-1',
+    'f-lig-T-2',
+    'f-lig-T-3',
+    'f-lig-S-0',
+    'f-lig-S-1',
+    'f-lig-S-2',
+    'f-lig-S-3',
+    'lc-chi-0-all',
+    'lc-chi-1-all',
+    'lc-chi-2-all',
+    'lc-chi-3-all',
+    'lc-Z-0-all',
+    'lc-Z-1-all',
+    'lc-Z-2-all',
+    'lc-Z-3-all',
+    'lc-I-2-all',
+    'lc-I-3-all',
+    'lc-T-0-all',
+    'lc-T-1-all',
+    'lc-T-2-all',
+    'lc-T-3-all',
+    'lc-S-3-all',
+    'lc-alpha-0-all',
+    'lc-alpha-1-all',
+    'lc-alpha-2-all',
+    'lc-alpha-3-all',
+    'D_lc-chi-2-all',
+    'D_lc-chi-3-all',
+    'D_lc-Z-1-all',
+    'D_lc-Z-2-all',
+    'D_lc-Z-3-all',
+    'D_lc-T-1-all',
+    'D_lc-T-2-all',
+    'D_lc-T-3-all',
+    'D_lc-alpha-1-all',
+    'D_lc-alpha-2-all',
+    'D_lc-alpha-3-all',
+    'tertiary_amide_sum',
+    'ester_sum',
+    'carbonyl_sum',
+    'logP_sum',
+    'MR_sum',
+    'aromatic_rings_sum',
+    'dbonds_sum',
+    'abonds_sum',
+    'tertiary_amide_mean',
+    'ester_mean',
+    'carbonyl_mean',
+    'logP_mean',
+    'MR_mean',
+    'aromatic_rings_mean',
+    'dbonds_mean',
+    'abonds_mean',
+    # "sum-func-chi-0-all",
+    # "sum-func-chi-1-all",
+    # "sum-func-chi-2-all",
+    # "sum-func-chi-3-all",
+    # "sum-func-Z-0-all",
+    # "sum-func-Z-1-all",
+    # "sum-func-Z-2-all",
+    # "sum-func-Z-3-all",
+    # "sum-func-I-0-all",
+    # "sum-func-I-1-all",
+    # "sum-func-I-2-all",
+    # "sum-func-I-3-all",
+    # "sum-func-T-0-all",
+    # "sum-func-T-1-all",
+    # "sum-func-T-2-all",
+    # "sum-func-T-3-all",
+    # "sum-func-S-0-all",
+    # "sum-func-S-1-all",
+    # "sum-func-S-2-all",
+    # "sum-func-S-3-all",
+    # "sum-func-alpha-0-all",
+    # "sum-func-alpha-1-all",
+    # "sum-func-alpha-2-all",
+    # "sum-func-alpha-3-all",
+    # "sum-D_func-chi-1-all",
+    # "sum-D_func-chi-2-all",
+    # "sum-D_func-chi-3-all",
+    # "sum-D_func-Z-1-all",
+    # "sum-D_func-Z-2-all",
+    # "sum-D_func-Z-3-all",
+    # "sum-D_func-T-1-all",
+    # "sum-D_func-T-2-all",
+    # "sum-D_func-T-3-all",
+    # "sum-D_func-S-1-all",
+    # "sum-D_func-S-2-all",
+    # "sum-D_func-S-3-all",
+    # "sum-D_func-alpha-1-all",
+    # "sum-D_func-alpha-2-all",
+    # "sum-D_func-alpha-3-all",
+    # "sum-f-lig-chi-0",
+    # "sum-f-lig-chi-1",
+    # "sum-f-lig-chi-2",
+    # "sum-f-lig-chi-3",
+    # "sum-f-lig-Z-0",
+    # "sum-f-lig-Z-1",
+    # "sum-f-lig-Z-2",
+    # "sum-f-lig-Z-3",
+    # "sum-f-lig-I-0",
+    # "sum-f-lig-I-1",
+    # "sum-f-lig-I-2",
+    # "sum-f-lig-I-3",
+    # "sum-f-lig-T-0",
+    # "sum-f-lig-T-1",
+    # "sum-f-lig-T-2",
+    # "sum-f-lig-T-3",
+    # "sum-f-lig-S-0",
+    # "sum-f-lig-S-1",
+    # "sum-f-lig-S-2",
+    # "sum-f-lig-S-3",
+    # "sum-lc-chi-0-all",
+    # "sum-lc-chi-1-all",
+    # "sum-lc-chi-2-all",
+    # "sum-lc-chi-3-all",
+    # "sum-lc-Z-0-all",
+    # "sum-lc-Z-1-all",
+    # "sum-lc-Z-2-all",
+    # "sum-lc-Z-3-all",
+    # "sum-lc-I-0-all",
+    # "sum-lc-I-1-all",
+    # "sum-lc-I-2-all",
+    # "sum-lc-I-3-all",
+    # "sum-lc-T-0-all",
+    # "sum-lc-T-1-all",
+    # "sum-lc-T-2-all",
+    # "sum-lc-T-3-all",
+    # "sum-lc-S-0-all",
+    # "sum-lc-S-1-all",
+    # "sum-lc-S-2-all",
+    # "sum-lc-S-3-all",
+    # "sum-lc-alpha-0-all",
+    # "sum-lc-alpha-1-all",
+    # "sum-lc-alpha-2-all",
+    # "sum-lc-alpha-3-all",
+    # "sum-D_lc-chi-1-all",
+    # "sum-D_lc-chi-2-all",
+    # "sum-D_lc-chi-3-all",
+    # "sum-D_lc-Z-1-all",
+    # "sum-D_lc-Z-2-all",
+    # "sum-D_lc-Z-3-all",
+    # "sum-D_lc-T-1-all",
+    # "sum-D_lc-T-2-all",
+    # "sum-D_lc-T-3-all",
+    # "sum-D_lc-S-1-all",
+    # "sum-D_lc-S-2-all",
+    # "sum-D_lc-S-3-all",
+    # "sum-D_lc-alpha-1-all",
+    # "sum-D_lc-alpha-2-all",
+    # "sum-D_lc-alpha-3-all",
+    # "sum-mc_CRY-chi-0-all",
+    # "sum-mc_CRY-chi-1-all",
+    # "sum-mc_CRY-chi-2-all",
+    # "sum-mc_CRY-chi-3-all",
+    # "sum-mc_CRY-Z-0-all",
+    # "sum-mc_CRY-Z-1-all",
+    # "sum-mc_CRY-Z-2-all",
+    # "sum-mc_CRY-Z-3-all",
+    # "sum-mc_CRY-I-0-all",
+    # "sum-mc_CRY-I-1-all",
+    # "sum-mc_CRY-I-2-all",
+    # "sum-mc_CRY-I-3-all",
+    # "sum-mc_CRY-T-0-all",
+    # "sum-mc_CRY-T-1-all",
+    # "sum-mc_CRY-T-2-all",
+    # "sum-mc_CRY-T-3-all",
+    # "sum-mc_CRY-S-0-all",
+    # "sum-mc_CRY-S-1-all",
+    # "sum-mc_CRY-S-2-all",
+    # "sum-mc_CRY-S-3-all",
+    # "sum-D_mc_CRY-chi-1-all",
+    # "sum-D_mc_CRY-chi-2-all",
+    # "sum-D_mc_CRY-chi-3-all",
+    # "sum-D_mc_CRY-Z-1-all",
+    # "sum-D_mc_CRY-Z-2-all",
+    # "sum-D_mc_CRY-Z-3-all",
+    # "sum-D_mc_CRY-T-1-all",
+    # "sum-D_mc_CRY-T-2-all",
+    # "sum-D_mc_CRY-T-3-all",
+    # "sum-D_mc_CRY-S-1-all",
+    # "sum-D_mc_CRY-S-2-all",
+    # "sum-D_mc_CRY-S-3-all",
+]
+
+# column of each feature in a feature vector
+FEATURE_INDEX = {name: i for i, name in enumerate(CHEMICAL_FEATURES)}
+
+# Families of RACs computed by molSimplify: metal center, linker connecting atoms, full linker and functional groups
+RAC_FAMILIES = ('mc', 'lc', 'f-lig', 'func')
+# molSimplify called the metal center RACs mc_CRY before the MOF RACs code was open sourced, the models use this name
+OLD_METAL_CENTER = 'mc_CRY'
+
+
+class SchemaMismatch(ValueError):
+    """The featurization does not produce (exactly) the features of the models"""
+
+
+def rac_family(name):
+    """Family of a RAC (e.g. lc for lc-chi-0-all and D_lc-Z-1-all), None if name is not a RAC"""
+    base = name[2:] if name.startswith('D_') else name
+    for family in (OLD_METAL_CENTER,) + RAC_FAMILIES:
+        if base.startswith(family + '-'):
+            return family
+    return None
+
+
+def model_name(name):
+    """Name of a RAC of molSimplify as in the models, i.e., mc-chi-0-all -> mc_CRY-chi-0-all"""
+    if rac_family(name) == 'mc':
+        return name.replace('mc-', OLD_METAL_CENTER + '-', 1)
+    return name
+
+
+RAC_FEATURES = [name for name in CHEMICAL_FEATURES if rac_family(name) is not None]
+LINKER_FEATURES = [name for name in CHEMICAL_FEATURES if rac_family(name) is None]
+LINKER_COLUMNS = np.array([FEATURE_INDEX[name] for name in LINKER_FEATURES], dtype=np.intp)
+
+
+def check_features(molecular_descriptors, rac_depth):
+    """Raises SchemaMismatch if the models use linker descriptors that are not computed (sums and means of
+    molecular_descriptors) or RACs deeper than rac_depth"""
+    computed = {name + suffix for name in molecular_descriptors for suffix in ('_sum', '_mean')}
+    unknown = [name for name in LINKER_FEATURES if name not in computed]
+    too_deep = [
+        name for name in RAC_FEATURES if any(part.isdigit() and int(part) > rac_depth for part in name.split('-'))
+    ]
+    if unknown or too_deep:
+        raise SchemaMismatch('The models use features that are not computed: {}'.format(unknown + too_deep))
+
+
+class RACSchema:
+    """Positions of the RACs of the models in the descriptors molSimplify returns for the given names"""
+
+    def __init__(self, names):
+        self.names = [model_name(name) if rac_family(name) is not None else None for name in names]
+        positions = {name: i for i, name in enumerate(self.names) if name is not None}
+        if len(positions) < sum(name is not None for name in self.names):
+            raise SchemaMismatch('molSimplify returned RACs with the old and the new names of the metal center')
+        missing = [name for name in RAC_FEATURES if name not in positions]
+        if missing:
+            raise SchemaMismatch('molSimplify does not compute {} RACs of the models, e.g. {}'.format(
+                len(missing), missing[:3]))
+        self.positions = np.array([positions[name] for name in RAC_FEATURES], dtype=np.intp)
+        self.columns = np.array([FEATURE_INDEX[name] for name in RAC_FEATURES], dtype=np.intp)
+
+    def gather(self, descriptors, features):
+        """Write the RACs of the models from descriptors (in the order of the names) into the feature vector"""
+        features[self.columns] = np.asarray(descriptors, dtype=np.float64)[self.positions]
+
+    def to_dict(self, descriptors):
+        """All RACs in descriptors, with the names of the models"""
+        return {name: value for name, value in zip(self.names, descriptors) if name is not None}
+
+
+@functools.lru_cache(maxsize=8)
+def rac_schema(names):
+    """The RACSchema for a tuple of names of molSimplify, compiled on first use"""
+    return RACSchema(names)
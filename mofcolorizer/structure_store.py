@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Keeps the uploaded structures on the server, the browser only gets a short token"""
+from __future__ import absolute_import
+
+import os
+
+from pymatgen import Structure
+
+from .cache import CACHE_DIR, LRUCache, SQLiteLRUCache, structure_hash
+
+
+class StructureStore:
+    """pymatgen Structures keyed by a token derived from their content. The serialized structures are kept in a
+    cache that is shared by all workers, the deserialized ones also in an in-memory LRU cache of each worker"""
+
+    def __init__(self, backend, max_in_memory=32):
+        self.backend = backend
+        self._structures = LRUCache(max_in_memory)
+
+    def put(self, structure):
+        """Store the structure and return its token"""
+        # another cell of the same structure is shown as it was uploaded
+        token = structure_hash(structure, canonical=False)[:16]
+        self.backend.set(token, structure.as_dict())
+        self._structures.set(token, structure)
+        return token
+
+    def get(self, token):
+        """Return the Structure for the token, or None if it is unknown (e.g. evicted)"""
+        structure = self._structures.get(token)
+        if structure is None:
+            structure_dict = self.backend.get(token)
+            if structure_dict is None:
+                return None
+            structure = Structure.from_dict(structure_dict)
+            self._structures.set(token, structure)
+        return structure
+
+
+STRUCTURE_STORE = StructureStore(
+    SQLiteLRUCache(
+        os.path.join(CACHE_DIR, 'structures.sqlite'),
+        table='structures',
+        max_entries=int(os.environ.get('MOFCOLORIZER_STRUCTURE_STORE_SIZE', 1000)),
+    ))
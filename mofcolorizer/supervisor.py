@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Runs the featurization stages (MOFid, RACs) in child processes with a wall-clock timeout, a memory ceiling and
+a CPU time limit, such that a pathological structure can neither block a worker forever nor use all its memory.
+
+The limits are set per stage with the environment variables MOFCOLORIZER_<STAGE>_TIMEOUT (s),
+MOFCOLORIZER_<STAGE>_MEMORY (MB, address space) and MOFCOLORIZER_<STAGE>_CPU (s), 0 disables a limit.
+"""
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import resource
+import signal
+import sys
+import time
+
+from . import metrics
+
+# (timeout, memory, CPU time). The JVM that MOFid starts for Systre reserves much more address space than it uses
+# (e.g. 1 GB for classes), it needs 4 GB to start. Under an RLIMIT_AS it limits its heap to half of it
+DEFAULT_LIMITS = {
+    'mofid': (300, 8192, 300),
+    'racs': (300, 8192, 300),
+}
+
+
+# stages started by this process that are not stopped yet
+_RUNNING = set()
+
+# a forked process (e.g. a stage or a worker of parallel.imap_unordered) did not start the stages of its parent
+os.register_at_fork(after_in_child=_RUNNING.clear)
+
+
+class StageError(RuntimeError):
+    """A stage failed, timed out or exceeded one of its limits"""
+
+
+def stop_all():
+    """Kill all stages this process started (and the programs they started)"""
+    for stage in list(_RUNNING):
+        stage.stop()
+
+
+def _exit_on_sigterm(signum, frame):  # pylint:disable=unused-argument
+    stop_all()
+    sys.exit(128 + signum)
+
+
+def stop_stages_on_sigterm():
+    """Called in processes that are terminated with SIGTERM (e.g. by parallel.imap_unordered after a timeout). The
+    stages run in their own process groups, i.e., they would keep running without this"""
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+
+def stage_limits(stage):
+    """(timeout in s, memory in MB, CPU time in s) of a stage, None if the limit is disabled"""
+    defaults = DEFAULT_LIMITS.get(stage, (0, 0, 0))
+    limits = []
+    for name, default in zip(('TIMEOUT', 'MEMORY', 'CPU'), defaults):
+        value = float(os.environ.get('MOFCOLORIZER_{}_{}'.format(stage.upper(), name), default))
+        limits.append(value or None)
+    return tuple(limits)
+
+
+def _set_limits(memory, cpu):
+    if memory:
+        size = int(memory * 1024**2)
+        resource.setrlimit(resource.RLIMIT_AS, (size, size))
+    if cpu:
+        # SIGXCPU at the soft limit, SIGKILL at the hard one. Also applies to the programs the stage starts
+        resource.setrlimit(resource.RLIMIT_CPU, (int(cpu), int(cpu) + 5))
+
+
+def _run_stage(connection, func, args, memory, cpu):
+    """Entry point of the stage process, sends (success, result or error message, metrics) to the parent"""
+    metrics.start_child()
+    # the handler of the parent is not the one of this process, SIGTERM was blocked in Stage.__init__
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+    # own process group, such that the programs started by the stage (e.g. Java) can be killed with it
+    os.setpgrp()
+    try:
+        _set_limits(memory, cpu)
+        result = func(*args)
+        connection.send((True, result, metrics.snapshot()))
+    except MemoryError:
+        connection.send((False, 'exceeded the memory limit of {:.0f} MB'.format(memory), metrics.snapshot()))
+    except Exception as e:  # pylint:disable=broad-except,invalid-name
+        connection.send((False, '{}: {}'.format(type(e).__name__, e), metrics.snapshot()))
+    finally:
+        connection.close()
+
+
+class Stage:
+    """func(*args) running in a child process under the limits of the stage, started on creation.
+    Several stages can run at the same time, result waits for one and raises StageError if it did not work."""
+
+    def __init__(self, name, func, *args):
+        self.name = name
+        self.timeout, self.memory, self.cpu = stage_limits(name)
+        self._connection, child_connection = multiprocessing.Pipe(duplex=False)
+        self._process = multiprocessing.Process(target=_run_stage,
+                                                args=(child_connection, func, args, self.memory, self.cpu))
+        # a SIGTERM between the start and the registration would leave the stage running (see stop_all)
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        try:
+            self._process.start()
+            _RUNNING.add(self)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        child_connection.close()
+        self._deadline = time.monotonic() + self.timeout if self.timeout else None
+
+    def result(self):
+        wait_time = max(0, self._deadline - time.monotonic()) if self._deadline is not None else None
+        try:
+            if not self._connection.poll(wait_time):
+                metrics.increment('timeouts', self.name)
+                raise StageError('{} timed out after {:.0f} s'.format(self.name, self.timeout))
+            try:
+                success, payload, child_metrics = self._connection.recv()
+            except EOFError:
+                self._process.join()
+                raise StageError('{} {}'.format(self.name, self._exit_reason()))
+            self._process.join()
+            metrics.merge(child_metrics)
+            if not success:
+                if payload.startswith('exceeded'):
+                    metrics.increment('limits_exceeded', self.name)
+                raise StageError('{} failed: {}'.format(self.name, payload))
+            return payload
+        finally:
+            self.stop()
+
+    def _exit_reason(self):
+        exitcode = self._process.exitcode
+        if self.cpu and exitcode in (-signal.SIGXCPU, -signal.SIGKILL):
+            metrics.increment('limits_exceeded', self.name)
+            return 'exceeded the CPU time limit of {:.0f} s'.format(self.cpu)
+        return 'exited with code {}'.format(exitcode)
+
+    def stop(self):
+        """Kill the process (and the programs it started) if it is still running"""
+        if self._process.is_alive():
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            except OSError:
+                self._process.kill()
+        self._process.join()
+        self._connection.close()
+        _RUNNING.discard(self)
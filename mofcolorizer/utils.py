@@ -3,10 +3,13 @@
 from __future__ import absolute_import
 
 import contextlib
+import math
 import os
 import shutil
 import tempfile
 
+import numpy as np
+from colormath import color_constants
 from colormath.color_conversions import convert_color
 from colormath.color_diff import delta_e_cie2000
 from colormath.color_objects import LabColor, sRGBColor
@@ -981,19 +984,175 @@ def get_delta_e(rgba, rgbb, upscaled=False):
     return delta_e
 
 
+# Constants of the sRGB -> XYZ (D65) -> Lab conversion, taken from colormath such that the
+# vectorized implementation below reproduces convert_color(sRGBColor, LabColor) exactly
+_RGB_TO_XYZ = sRGBColor.conversion_matrices['rgb_to_xyz']
+_ILLUMINANT_XYZ = np.array(color_constants.ILLUMINANTS['2'][sRGBColor.native_illuminant])
+
+# number of query colors that are compared against the full palette at once, bounds the memory of the temporaries
+_CHUNKSIZE = 2048
+
+# numpy's power is not always bit-identical to the libm pow that colormath uses via math.pow
+_POW = np.vectorize(math.pow, otypes=[np.float64])
+
+_XKCD_NAMES = None
+_XKCD_LAB = None
+
+
+def _rgb_to_lab(rgb, upscaled=False):
+    """Convert an array of sRGB colors with shape (n, 3) to CIE Lab (D65), following the colormath implementation"""
+    rgb = np.asarray(rgb, dtype=np.float64).reshape(-1, 3)
+    if upscaled:
+        rgb = rgb / 255.0
+
+    linear = rgb / 12.92
+    gamma = rgb > 0.04045
+    if gamma.any():
+        linear[gamma] = _POW((rgb[gamma] + 0.055) / 1.055, 2.4)
+
+    # stacked matrix-vector products, as numpy.dot(matrix, vector) in colormath
+    xyz = np.matmul(_RGB_TO_XYZ, linear[:, :, np.newaxis])[:, :, 0]
+    xyz = np.maximum(xyz, 0.0) / _ILLUMINANT_XYZ
+
+    cubic = xyz > color_constants.CIE_E
+    scaled = (7.787 * xyz) + (16.0 / 116.0)
+    if cubic.any():
+        scaled[cubic] = _POW(xyz[cubic], 1.0 / 3.0)
+    xyz = scaled
+
+    lab = np.empty_like(xyz)
+    lab[:, 0] = (116.0 * xyz[:, 1]) - 16.0
+    lab[:, 1] = 500.0 * (xyz[:, 0] - xyz[:, 1])
+    lab[:, 2] = 200.0 * (xyz[:, 1] - xyz[:, 2])
+    return lab
+
+
+def _delta_e_cie2000(lab1, lab2):  # pylint:disable=invalid-name,too-many-locals
+    """CIEDE2000 between Lab arrays that broadcast against each other (last axis is L, a, b).
+    Follows colormath.color_diff_matrix.delta_e_cie2000 operation by operation (with Kl=Kc=Kh=1)"""
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    avg_Lp = (L1 + L2) / 2.0
+
+    C1 = np.sqrt(np.sum(np.power(lab1[..., 1:], 2), axis=-1))
+    C2 = np.sqrt(np.sum(np.power(lab2[..., 1:], 2), axis=-1))
+
+    avg_C1_C2 = (C1 + C2) / 2.0
+
+    G = 0.5 * (1 - np.sqrt(np.power(avg_C1_C2, 7.0) / (np.power(avg_C1_C2, 7.0) + np.power(25.0, 7.0))))
+
+    a1p = (1.0 + G) * a1
+    a2p = (1.0 + G) * a2
+
+    C1p = np.sqrt(np.power(a1p, 2) + np.power(b1, 2))
+    C2p = np.sqrt(np.power(a2p, 2) + np.power(b2, 2))
+
+    avg_C1p_C2p = (C1p + C2p) / 2.0
+
+    h1p = np.degrees(np.arctan2(b1, a1p))
+    h1p = h1p + (h1p < 0) * 360
+
+    h2p = np.degrees(np.arctan2(b2, a2p))
+    h2p = h2p + (h2p < 0) * 360
+
+    avg_Hp = (((np.fabs(h1p - h2p) > 180) * 360) + h1p + h2p) / 2.0
+
+    T = 1 - 0.17 * np.cos(np.radians(avg_Hp - 30)) + \
+        0.24 * np.cos(np.radians(2 * avg_Hp)) + \
+        0.32 * np.cos(np.radians(3 * avg_Hp + 6)) - \
+        0.2 * np.cos(np.radians(4 * avg_Hp - 63))
+
+    diff_h2p_h1p = h2p - h1p
+    delta_hp = diff_h2p_h1p + (np.fabs(diff_h2p_h1p) > 180) * 360
+    delta_hp = delta_hp - (h2p > h1p) * 720
+
+    delta_Lp = L2 - L1
+    delta_Cp = C2p - C1p
+    delta_Hp = 2 * np.sqrt(C2p * C1p) * np.sin(np.radians(delta_hp) / 2.0)
+
+    S_L = 1 + ((0.015 * np.power(avg_Lp - 50, 2)) / np.sqrt(20 + np.power(avg_Lp - 50, 2.0)))
+    S_C = 1 + 0.045 * avg_C1p_C2p
+    S_H = 1 + 0.015 * avg_C1p_C2p * T
+
+    delta_ro = 30 * np.exp(-(np.power(((avg_Hp - 275) / 25), 2.0)))
+    R_C = np.sqrt((np.power(avg_C1p_C2p, 7.0)) / (np.power(avg_C1p_C2p, 7.0) + np.power(25.0, 7.0)))
+    R_T = -2 * R_C * np.sin(2 * np.radians(delta_ro))
+
+    return np.sqrt(
+        np.power(delta_Lp / S_L, 2) + np.power(delta_Cp / S_C, 2) + np.power(delta_Hp / S_H, 2) + R_T *
+        (delta_Cp / S_C) * (delta_Hp / S_H))
+
+
+def get_delta_e_array(rgba, rgbb, upscaled=False):
+    """Vectorized get_delta_e for arrays of RGB colors with shape (..., 3) that broadcast against each other, e.g.
+    (n, 3) and (n, 3) for n pairs or (n, 1, 3) and (1, m, 3) for all pairs. Returns the CIE2000 differences with the
+    broadcast shape (without the last axis), if upscaled the range is 0-255, else between 0 and 1"""
+    rgba = np.asarray(rgba, dtype=np.float64)
+    rgbb = np.asarray(rgbb, dtype=np.float64)
+    laba = _rgb_to_lab(rgba, upscaled).reshape(rgba.shape)
+    labb = _rgb_to_lab(rgbb, upscaled).reshape(rgbb.shape)
+    return _delta_e_cie2000(laba, labb)
+
+
+def get_delta_e_matrix(rgba, rgbb, upscaled=False):
+    """CIE2000 differences between all pairs of two lists of RGB colors with shapes (n, 3) and (m, 3), shape (n, m)"""
+    laba = _rgb_to_lab(rgba, upscaled)
+    labb = _rgb_to_lab(rgbb, upscaled)
+
+    result = np.empty((len(laba), len(labb)))
+    # chunks of rows bound the memory of the temporaries
+    rows = max(1, _CHUNKSIZE * 1024 // max(1, len(labb)))
+    for start in range(0, len(laba), rows):
+        result[start:start + rows] = _delta_e_cie2000(laba[start:start + rows, np.newaxis, :], labb[np.newaxis, :, :])
+    return result
+
+
+def _xkcd_lab_table():
+    """Names and Lab coordinates (as array with shape (n, 3)) of the xkcd colors, computed on first use"""
+    global _XKCD_NAMES, _XKCD_LAB  # pylint:disable=global-statement
+    if _XKCD_LAB is None:
+        _XKCD_NAMES = np.array(list(XKCD_RGB_DICT.keys()))
+        _XKCD_LAB = _rgb_to_lab(list(XKCD_RGB_DICT.values()), upscaled=True)
+    return _XKCD_NAMES, _XKCD_LAB
+
+
+def closest_names(requested_colours):
+    """Return the perceptually closest color names from the xkcd survey for an array of RGB tuples in the range 0-255"""
+    names, palette = _xkcd_lab_table()
+    lab = _rgb_to_lab(requested_colours, upscaled=True)
+
+    result = []
+    for start in range(0, len(lab), _CHUNKSIZE):
+        distances = _delta_e_cie2000(palette[np.newaxis, :, :], lab[start:start + _CHUNKSIZE, np.newaxis, :])
+        # on ties, the last color in XKCD_RGB_DICT wins (as it did in the dictionary based implementation)
+        last_min = distances.shape[1] - 1 - np.argmin(distances[:, ::-1], axis=1)
+        result.extend(names[last_min].tolist())
+    return result
+
+
 def closest_name(requested_colour):
     """Return the perceptually closest color name from the xkcd survey given and RGB tuple in the range 0-255"""
-    min_colours = {}
-    for name, rgb in XKCD_RGB_DICT.items():
-        distance = get_delta_e(rgb, requested_colour, upscaled=True)
-        min_colours[distance] = name
-    return min_colours[min(min_colours.keys())]
+    return closest_names([requested_colour])[0]
+
+
+def _get_temp_dir():
+    """Directory for the files that the external featurization tools need, in memory (/dev/shm) if possible"""
+    temp_dir = os.environ.get('MOFCOLORIZER_TMPDIR')
+    if temp_dir:
+        return temp_dir
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None  # system default
+
+
+TEMP_DIR = _get_temp_dir()
 
 
 @contextlib.contextmanager
 def make_temp_directory():
     """Contextmanager that creates temp dir"""
-    temp_dir = tempfile.mkdtemp()
+    temp_dir = tempfile.mkdtemp(dir=TEMP_DIR)
     try:
         yield temp_dir
     finally:
@@ -1003,7 +1162,7 @@ def make_temp_directory():
 @contextlib.contextmanager
 def temp():
     """Contextmanager that creates temp file"""
-    tmp = tempfile.NamedTemporaryFile(delete=False)
+    tmp = tempfile.NamedTemporaryFile(delete=False, dir=TEMP_DIR)
     try:
         yield tmp
     finally:
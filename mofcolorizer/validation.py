@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Cheap checks of a parsed structure, such that structures that MOFid or molSimplify cannot handle are rejected
+in milliseconds instead of failing after tens of seconds of featurization"""
+from __future__ import absolute_import
+
+import itertools
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# more atoms in the primitive cell make the featurization too slow for the web app
+MAX_ATOMS = int(os.environ.get('MOFCOLORIZER_MAX_ATOMS', 2000))
+# more atoms in the uploaded cell make the reduction to the primitive cell too slow. An F-centered cell has four times
+# the atoms of the primitive one
+MAX_INPUT_ATOMS = int(os.environ.get('MOFCOLORIZER_MAX_INPUT_ATOMS', 4 * MAX_ATOMS))
+# atoms closer than this (in Angstrom) are considered clashing, e.g. from unresolved disorder
+MIN_DISTANCE = float(os.environ.get('MOFCOLORIZER_MIN_DISTANCE', 0.5))
+
+NON_METALS = {
+    'H', 'He', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Si', 'P', 'S', 'Cl', 'Ar', 'Ge', 'As', 'Se', 'Br', 'Kr', 'Sb', 'Te',
+    'I', 'Xe', 'At', 'Rn'
+}
+
+
+def find_overlap(structure, min_distance=MIN_DISTANCE):
+    """Returns (i, j, distance) for the closest pair of sites (including periodic images) that are closer than
+    min_distance, or None. Uses a KD-tree of the sites and their images in the neighboring cells"""
+    if len(structure) == 0:
+        return None
+    lattice = structure.lattice.matrix
+    cart = np.mod(structure.frac_coords, 1) @ lattice
+    shifts = np.array(list(itertools.product((-1, 0, 1), repeat=3))) @ lattice
+    images = (cart[np.newaxis, :, :] + shifts[:, np.newaxis, :]).reshape(-1, 3)
+
+    # the nearest image of a site is the site itself (or one at the same position)
+    distances, indices = cKDTree(images).query(cart, k=2)
+    closest = int(np.argmin(distances[:, 1]))
+    if distances[closest, 1] >= min_distance:
+        return None
+    return closest, int(indices[closest, 1] % len(structure)), float(distances[closest, 1])
+
+
+def structure_problem(structure):
+    """Reason why the (parsed, not yet primitive) structure cannot be featurized, None if it looks fine"""
+    if len(structure) == 0:
+        return 'the structure contains no atoms'
+    if len(structure) > MAX_INPUT_ATOMS:
+        return 'the cell has {} atoms, at most {} are supported'.format(len(structure), MAX_INPUT_ATOMS)
+    if not structure.is_ordered:
+        return 'the structure contains partially occupied sites'
+
+    symbols = {element.symbol for element in structure.composition.elements}
+    if not symbols - NON_METALS:
+        return 'the structure contains no metal'
+
+    overlap = find_overlap(structure)
+    if overlap is not None:
+        i, j, distance = overlap
+        return 'the atoms {} ({}) and {} ({}) are only {:.2f} A apart'.format(i, structure[i].specie.symbol, j,
+                                                                              structure[j].specie.symbol, distance)
+    return None
+
+
+def size_problem(structure, max_atoms=MAX_ATOMS):
+    """Reason why the primitive structure is too large to be featurized, None if it is fine"""
+    if len(structure) > max_atoms:
+        return 'the primitive cell has {} atoms, at most {} are supported'.format(len(structure), max_atoms)
+    return None
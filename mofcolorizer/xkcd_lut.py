@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Optional lookup table with the closest xkcd color for every 8-bit RGB color.
+
+The table is a (256, 256, 256) uint16 array of indices into XKCD_RGB_DICT (32 MB), memory-mapped by default such
+that all processes share one copy. It is built with closest_names, i.e., lookups give exactly its result:
+
+python -m mofcolorizer.xkcd_lut [--output path] [--workers 8]
+
+Next to the table, a json file records the checksum of the palette it was built for. If the table does not exist
+or was built for another palette, lookup_names computes the names with closest_names.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import warnings
+
+import numpy as np
+
+from .utils import XKCD_RGB_DICT, closest_name, closest_names
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+LUT_PATH = os.environ.get('MOFCOLORIZER_XKCD_LUT', os.path.join(THIS_DIR, 'xkcd_lut.npy'))
+# 'r' to memory-map the table, '' to read it into memory
+LUT_MMAP_MODE = os.environ.get('MOFCOLORIZER_XKCD_LUT_MMAP_MODE', 'r') or None
+
+_NAMES = np.array(list(XKCD_RGB_DICT.keys()))
+_LUT = None
+_LUT_LOADED = False
+_LOCK = threading.Lock()
+
+
+def palette_checksum():
+    """sha256 of the names and RGB values of XKCD_RGB_DICT, in order"""
+    return hashlib.sha256(json.dumps(list(XKCD_RGB_DICT.items())).encode()).hexdigest()
+
+
+def _metadata_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def _build_plane(red):
+    """Indices of the closest colors for all colors with the given red value, shape (256, 256)"""
+    green, blue = np.meshgrid(np.arange(256), np.arange(256), indexing='ij')
+    colors = np.stack([np.full(green.size, red), green.ravel(), blue.ravel()], axis=1)
+    index = {name: i for i, name in enumerate(_NAMES)}
+    return np.array([index[name] for name in closest_names(colors)], dtype=np.uint16).reshape(256, 256)
+
+
+def build_lut(path=LUT_PATH, n_workers=None):
+    """Compute the table and write it (and the json with the palette checksum) to path"""
+    lut = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.uint16, shape=(256, 256, 256))
+    with multiprocessing.Pool(n_workers) as pool:
+        for red, plane in enumerate(pool.imap(_build_plane, range(256))):
+            lut[red] = plane
+            print('\r{}/256'.format(red + 1), end='', file=sys.stderr)
+    print(file=sys.stderr)
+    lut.flush()
+    del lut
+    os.replace(path + '.tmp', path)
+    with open(_metadata_path(path), 'w') as handle:
+        json.dump({'palette_checksum': palette_checksum()}, handle)
+
+
+def verify_lut(lut, n_samples=10000, seed=0):
+    """Compare random entries of the table with closest_name, returns the colors that do not match"""
+    colors = np.random.default_rng(seed).integers(0, 256, size=(n_samples, 3))
+    return [tuple(color) for color in colors if _NAMES[lut[tuple(color)]] != closest_name(color)]
+
+
+def load_lut(path=LUT_PATH, mmap_mode=LUT_MMAP_MODE):
+    """The table, or None if it does not exist or was built for another palette"""
+    try:
+        with open(_metadata_path(path)) as handle:
+            metadata = json.load(handle)
+        lut = np.load(path, mmap_mode=mmap_mode)
+    except (OSError, ValueError):
+        return None
+    if metadata.get('palette_checksum') != palette_checksum() or lut.shape != (256, 256, 256):
+        warnings.warn('The xkcd lookup table {} does not match the palette, rebuild it'.format(path))
+        return None
+    return lut
+
+
+def _get_lut():
+    global _LUT, _LUT_LOADED  # pylint:disable=global-statement
+    if not _LUT_LOADED:
+        with _LOCK:
+            if not _LUT_LOADED:
+                _LUT = load_lut()
+                _LUT_LOADED = True
+    return _LUT
+
+
+def lookup_names(requested_colours):
+    """Same result as closest_names, from the lookup table for integer colors in the range 0-255 if it exists"""
+    colors = np.asarray(requested_colours).reshape(-1, 3)
+    lut = _get_lut()
+    if lut is None:
+        return closest_names(colors)
+
+    in_cube = np.all((colors >= 0) & (colors <= 255) & (colors == np.floor(colors)), axis=1)
+    names = np.empty(len(colors), dtype=object)
+    cube = colors[in_cube].astype(np.intp)
+    names[in_cube] = _NAMES[lut[cube[:, 0], cube[:, 1], cube[:, 2]]].tolist()
+    if not in_cube.all():
+        names[~in_cube] = closest_names(colors[~in_cube])
+    return names.tolist()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Build the lookup table of the closest xkcd colors')
+    parser.add_argument('-o', '--output', default=LUT_PATH)
+    parser.add_argument('-w', '--workers', type=int, help='number of processes, default: number of CPUs')
+    parser.add_argument('--verify', type=int, default=10000, help='number of entries to compare with closest_name')
+    args = parser.parse_args(args)
+
+    build_lut(args.output, args.workers)
+    mismatches = verify_lut(np.load(args.output, mmap_mode='r'), args.verify)
+    if mismatches:
+        raise SystemExit('{} entries do not match closest_name, e.g. {}'.format(len(mismatches), mismatches[:5]))
+    print('{} random entries match closest_name'.format(args.verify), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,10 +6,12 @@ from setuptools import setup
 setup(
     name='mofcolorizer',
     version='v0.1-alpha',
-    packages=['colorml'],
+    packages=['mofcolorizer'],
+    package_data={'mofcolorizer': ['schema_structure.cif']},
     url='',
     license='GPL-3.0',
     install_requires=[],
+    entry_points={'console_scripts': ['mofcolorizer=mofcolorizer.cli:main']},
     extras_require={
         'testing': ['pytest', 'pytest-cov<2.11'],
         'docs': ['sphinx-rtd-theme', 'sphinxcontrib-bibtex'],
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""The vectorized color differences and name lookups against reference values computed once with colormath
+(convert_color to LabColor and delta_e_cie2000, the names by comparing with every color of XKCD_RGB_DICT)"""
+from __future__ import absolute_import
+
+import numpy as np
+import pytest
+
+from mofcolorizer.utils import closest_names, get_delta_e_array
+from mofcolorizer.xkcd_lut import lookup_names
+
+# (rgb a, rgb b, CIEDE2000) in the range 0-255
+UPSCALED_PAIRS = [
+    ((0, 0, 0), (255, 255, 255), 99.99998490203575),
+    ((229, 0, 0), (3, 67, 223), 49.29173614347378),
+    ((120, 60, 30), (121, 61, 29), 0.6856418371525467),
+    ((12, 200, 90), (200, 12, 90), 87.68072349532086),
+    ((255, 255, 0), (250, 250, 10), 1.0706240509930474),
+    ((128, 128, 128), (130, 126, 129), 3.115215300953809),
+    ((3, 3, 3), (10, 2, 8), 4.213120475404695),
+    ((80, 20, 160), (75, 30, 140), 3.2788463050891847),
+]
+
+# in the range 0-1
+PAIRS = [
+    ((0.1, 0.5, 0.9), (0.2, 0.4, 0.8), 10.22338606698372),
+    ((1.0, 0.0, 0.5), (0.9, 0.1, 0.5), 5.121540316074772),
+]
+
+NAMES = [
+    ((0, 0, 0), 'black'),
+    ((255, 255, 255), 'white'),
+    ((229, 0, 0), 'red'),
+    ((120, 60, 30), 'reddish brown'),
+    ((12, 200, 90), 'shamrock green'),
+    ((80, 20, 160), 'indigo blue'),
+    ((128, 128, 128), 'medium grey'),
+    ((250, 200, 210), 'pale pink'),
+    ((40, 90, 60), 'pine'),
+]
+
+
+@pytest.mark.parametrize('pairs, upscaled', [(UPSCALED_PAIRS, True), (PAIRS, False)])
+def test_get_delta_e_array(pairs, upscaled):
+    rgba, rgbb, expected = zip(*pairs)
+    np.testing.assert_allclose(get_delta_e_array(rgba, rgbb, upscaled=upscaled), expected, rtol=0, atol=1e-9)
+
+
+def test_get_delta_e_array_broadcasts():
+    rgba, rgbb, expected = zip(*UPSCALED_PAIRS)
+    matrix = get_delta_e_array(np.array(rgba)[:, np.newaxis, :], np.array(rgbb)[np.newaxis, :, :], upscaled=True)
+    assert matrix.shape == (len(rgba), len(rgbb))
+    np.testing.assert_allclose(np.diag(matrix), expected, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('function', [closest_names, lookup_names])
+def test_names(function):
+    colors, expected = zip(*NAMES)
+    assert function(colors) == list(expected)